@@ -4,8 +4,12 @@ import time
 import os
 from PIL import Image
 import base64
+import uuid
+import json
 
 API_URL = "http://localhost:8000"  
+# Same as TERMINAL_STATUSES in main.py: the server ends the event stream on these
+TERMINAL_STATUSES = {"completed", "failed", "expired"}
 
 st.set_page_config(page_title="Math Visualizer", page_icon="🧮", layout="wide")
 
@@ -78,6 +82,75 @@ def get_video_download_link(video_path, link_text="Download Video"):
         return href
 
 
+def stream_job_events(job_id):
+    """Yield job snapshots pushed by the server over /events/{job_id}."""
+    with requests.get(
+        f"{API_URL}/events/{job_id}", stream=True, timeout=(5, 60)
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data: "):
+                yield json.loads(line[len("data: ") :])
+
+
+def job_updates(job_id):
+    """Yield job snapshots as they change, polling /status only if the event stream
+    can't be used."""
+    try:
+        for data in stream_job_events(job_id):
+            yield data
+            if data["status"] in TERMINAL_STATUSES:
+                return
+    except requests.RequestException:
+        pass
+
+    while True:
+        response = requests.get(f"{API_URL}/status/{job_id}")
+
+        # Always try to parse the response, even if not 200
+        try:
+            data = response.json() if response.status_code == 200 else {"status": "error", "error": response.text}
+        except Exception as json_error:
+            data = {"status": "error", "error": f"Invalid response: {str(json_error)}"}
+
+        yield data
+        if data.get("status") in TERMINAL_STATUSES:
+            return
+        time.sleep(3)
+
+
+def fetch_jobs():
+    """Fetch every job with its status through the paginated /jobs endpoint.
+    Returns None if the single-page job list is unchanged since the last fetch."""
+    jobs = []
+    pages = 0
+    cursor = None
+    headers = {}
+    if st.session_state.get("jobs_etag"):
+        headers["If-None-Match"] = st.session_state.jobs_etag
+
+    while True:
+        params = {"limit": 200}
+        if cursor:
+            params["cursor"] = cursor
+        response = requests.get(f"{API_URL}/jobs", params=params, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        data = response.json()
+        pages += 1
+        jobs.extend(data["jobs"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+        headers = {}
+
+    # Only a single page fully describes the list, so only then is the ETag reusable
+    st.session_state.jobs_etag = response.headers.get("ETag") if pages == 1 else None
+    return jobs
+
+
 def poll_job_status(job_id):
     status_placeholder = st.empty()
     progress_bar = st.progress(0)
@@ -89,19 +162,29 @@ def poll_job_status(job_id):
     stages = {
         "queued": "Job is queued",
         "generating_code": "Generating Manim code",
+        "racing_candidates": "Generating candidate scripts in parallel",
+        "validating_code": "Validating generated code",
+        "validating": "Dry-running the scene",
         "rendering_video": "Rendering visualization video",
         "processing_video": "Processing video file",
+        "preview_ready": "Preview ready! A high quality version is rendering",
         "completed": "Visualization complete!",
         "failed": "Visualization failed",
+        "expired": "Video expired and was removed from storage",
     }
 
     progress_values = {
         "queued": 0.1,
         "generating_code": 0.3,
+        "racing_candidates": 0.4,
+        "validating_code": 0.5,
+        "validating": 0.55,
         "rendering_video": 0.7,
         "processing_video": 0.9,
+        "preview_ready": 1.0,
         "completed": 1.0,
         "failed": 1.0,
+        "expired": 1.0,
     }
 
     current_status = "queued"
@@ -110,19 +193,8 @@ def poll_job_status(job_id):
 
     start_time = time.time()
 
-    while current_status not in ["completed", "failed"]:
-        try:
-            response = requests.get(f"{API_URL}/status/{job_id}")
-            log_response = requests.get(f"{API_URL}/logs/{job_id}")
-
-            # Always try to parse the responses, even if not 200
-            try:
-                data = response.json() if response.status_code == 200 else {"status": "error", "error": response.text}
-                log_data = log_response.json() if log_response.status_code == 200 else {"error": log_response.text}
-            except Exception as json_error:
-                data = {"status": "error", "error": f"Invalid response: {str(json_error)}"}
-                log_data = {"error": str(json_error)}
-                
+    try:
+        for data in job_updates(job_id):
             # Continue if we at least got a status
             current_status = data["status"]
             error_message = data.get("error", "")
@@ -185,17 +257,20 @@ def poll_job_status(job_id):
             else:
                 status_message = stages.get(current_status, current_status)
 
-            if retry_count > 0 and current_status not in ["completed", "failed"]:
+            if data.get("queue_position"):
+                status_message += f" (position {data['queue_position']} in queue)"
+
+            if retry_count > 0 and current_status not in TERMINAL_STATUSES:
                 status_placeholder.markdown(
                     f"<div class='status-retry'>🔄 {status_message} (Retry {retry_count}) - Elapsed: {elapsed_str}</div>",
                     unsafe_allow_html=True,
                 )
-            elif current_status == "failed":
+            elif current_status in ["failed", "expired"]:
                 status_placeholder.markdown(
                     f"<div class='status-error'>⚠️ {status_message}: {error_message}</div>",
                     unsafe_allow_html=True,
                 )
-            elif current_status == "completed":
+            elif current_status in ["completed", "preview_ready"]:
                 status_placeholder.markdown(
                     f"<div class='status-complete'>✅ {status_message} - Total time: {elapsed_str}</div>",
                     unsafe_allow_html=True,
@@ -212,16 +287,13 @@ def poll_job_status(job_id):
                     unsafe_allow_html=True,
                 )
 
-            if current_status == "completed":
+            if current_status in TERMINAL_STATUSES | {"preview_ready"}:
                 break
-
-            time.sleep(3)
-        except Exception as e:
-            status_placeholder.markdown(
-                f"<div class='status-error'>⚠️ Error: {str(e)}</div>",
-                unsafe_allow_html=True,
-            )
-            break
+    except Exception as e:
+        status_placeholder.markdown(
+            f"<div class='status-error'>⚠️ Error: {str(e)}</div>",
+            unsafe_allow_html=True,
+        )
 
     return current_status, video_path, error_message
 
@@ -236,6 +308,9 @@ def main():
         unsafe_allow_html=True,
     )
 
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
+
     tab1, tab2, tab3 = st.tabs(
         ["Generate Visualization", "Chat with Assistant", "View Previous Jobs"]
     )
@@ -261,7 +336,10 @@ def main():
             )
 
             try:
-                response = requests.post(f"{API_URL}/generate", json={"topic": topic})
+                response = requests.post(
+                    f"{API_URL}/generate",
+                    json={"topic": topic, "session_id": st.session_state.session_id},
+                )
 
                 if response.status_code == 200:
                     data = response.json()
@@ -271,7 +349,7 @@ def main():
 
                     status, video_path, error = poll_job_status(job_id)
 
-                    if status == "completed":
+                    if status in ["completed", "preview_ready"]:
                         st.markdown(
                             "<div class='sub-header'>Visualization Result</div>",
                             unsafe_allow_html=True,
@@ -279,6 +357,10 @@ def main():
 
                         video_url = f"{API_URL}/video/{job_id}"
                         st.video(video_url)
+                        if status == "preview_ready":
+                            st.info(
+                                "This is a quick preview. The same link will serve the high quality version once it finishes rendering."
+                            )
 
                         st.markdown(
                             f"[Download Video]({video_url})", unsafe_allow_html=False
@@ -348,25 +430,33 @@ def main():
                 unsafe_allow_html=True,
             )
 
+            response_placeholder = st.empty()
             with st.spinner("Thinking..."):
                 try:
-                    response = requests.post(
-                        f"{API_URL}/chat", json={"message": chat_message}
-                    )
-
-                    if response.status_code == 200:
-                        assistant_response = response.json()["response"]
-
-                        st.session_state.chat_history.append(
-                            {"role": "assistant", "content": assistant_response}
-                        )
+                    with requests.post(
+                        f"{API_URL}/chat",
+                        json={
+                            "message": chat_message,
+                            "session_id": st.session_state.session_id,
+                        },
+                        stream=True,
+                    ) as response:
+                        if response.status_code == 200:
+                            assistant_response = ""
+                            for chunk in response.iter_content(
+                                chunk_size=None, decode_unicode=True
+                            ):
+                                assistant_response += chunk
+                                response_placeholder.markdown(
+                                    f"<div class='chat-assistant'>🤖 <b>Assistant:</b> \n{assistant_response}</div>",
+                                    unsafe_allow_html=True,
+                                )
 
-                        st.markdown(
-                            f"<div class='chat-assistant'>🤖 <b>Assistant:</b> \n{assistant_response}</div>",
-                            unsafe_allow_html=True,
-                        )
-                    else:
-                        st.error(f"Failed to get response: {response.text}")
+                            st.session_state.chat_history.append(
+                                {"role": "assistant", "content": assistant_response}
+                            )
+                        else:
+                            st.error(f"Failed to get response: {response.text}")
 
                 except Exception as e:
                     st.error(f"Error: {str(e)}")
@@ -384,34 +474,27 @@ def main():
 
         if st.button("Refresh Job List"):
             try:
-                response = requests.get(f"{API_URL}/list-jobs")
-                if response.status_code == 200:
-                    jobs = response.json()["jobs"]
-                    if not jobs:
-                        st.info("No previous jobs found")
-                    else:
-                        st.session_state.job_history = []
-                        for job in jobs:
-                            job_id = job["job_id"]
-                            status_response = requests.get(f"{API_URL}/status/{job_id}")
-                            if status_response.status_code == 200:
-                                status_data = status_response.json()
-                                st.session_state.job_history.append(
-                                    {
-                                        "job_id": job_id,
-                                        "topic": job["topic"],
-                                        "status": status_data["status"],
-                                        "video_url": (
-                                            f"{API_URL}/video/{job_id}"
-                                            if status_data["status"] == "completed"
-                                            else None
-                                        ),
-                                    }
-                                )
-                        st.success(f"Retrieved {len(jobs)} jobs")
-                        st.rerun()
+                jobs = fetch_jobs()
+                if jobs is None:
+                    st.info("Job list is up to date")
+                elif not jobs:
+                    st.info("No previous jobs found")
                 else:
-                    st.error(f"Failed to get job list: {response.text}")
+                    st.session_state.job_history = [
+                        {
+                            "job_id": job["job_id"],
+                            "topic": job["topic"],
+                            "status": job["status"],
+                            "video_url": (
+                                f"{API_URL}/video/{job['job_id']}"
+                                if job["video_available"]
+                                else None
+                            ),
+                        }
+                        for job in jobs
+                    ]
+                    st.success(f"Retrieved {len(jobs)} jobs")
+                    st.rerun()
             except Exception as e:
                 st.error(f"Error refreshing jobs: {str(e)}")
 
@@ -435,7 +518,7 @@ def main():
                         except Exception as e:
                             st.error(f"Error fetching logs: {str(e)}")
 
-                    if job["status"] == "completed" and job.get("video_url"):
+                    if job["status"] in ["completed", "preview_ready"] and job.get("video_url"):
                         st.video(job["video_url"])
                         st.markdown(
                             f"[Download Video]({job['video_url']})",
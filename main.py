@@ -1,13 +1,16 @@
 import uvicorn
 import configparser
 import fastapi
+from fastapi import Request, Response
 from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.exceptions import HTTPException
 from fastapi import BackgroundTasks
 import os
 import sys
 from pydantic import BaseModel
-from anthropic import AsyncClient
+import anthropic
+from anthropic import AsyncClient, DefaultAsyncHttpxClient
+import httpx
 import subprocess
 import logging
 import time
@@ -16,9 +19,27 @@ import uuid
 import shutil
 import re
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Literal
 import asyncio
 import io
+import json
+import ast
+import hashlib
+import builtins
+import functools
+import importlib
+import contextlib
+import glob
+import threading
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import tempfile
+import heapq
+import itertools
+from collections import deque
+from collections import OrderedDict
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -27,7 +48,239 @@ logger = logging.getLogger(__name__)
 
 config = configparser.ConfigParser()
 config.read("config.ini")
-__anthropic = AsyncClient(api_key=config["ANTHROPIC"]["API_TOKEN"])
+RETRYABLE_API_ERRORS = (
+    anthropic.RateLimitError,
+    anthropic.InternalServerError,
+    anthropic.APIConnectionError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+
+class TokenBucket:
+    """Limiter that refills capacity_per_minute units evenly over each minute."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.available = capacity_per_minute
+        self.rate = capacity_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self._refill()
+            self.available -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.available = min(self.capacity, self.available + max(0, amount))
+
+
+class AnthropicGateway:
+    """Shared access to the Anthropic API with concurrency caps, request and token
+    rate limits, jittered exponential backoff and a circuit breaker."""
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        max_concurrency: int,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_attempts: int,
+        breaker_threshold: int,
+        breaker_cooldown: float,
+    ):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_attempts = max_attempts
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=200)
+
+    def _check_circuit(self):
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.breaker_cooldown:
+            self.rejected += 1
+            raise CircuitOpenError(
+                "Anthropic API is unavailable, failing fast until it recovers"
+            )
+
+    def _record_success(self, latency: float):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.latencies.append(latency)
+
+    def _record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.breaker_threshold:
+            if self.opened_at is None:
+                logger.error("Anthropic circuit breaker opened")
+            self.opened_at = time.monotonic()
+
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(60.0, 2.0**attempt))
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", 0)))
+            except ValueError:
+                pass
+        return delay
+
+    @staticmethod
+    def _estimate_tokens(kwargs) -> int:
+        text = str(kwargs.get("system", "")) + str(kwargs.get("messages", ""))
+        return len(text) // 4 + kwargs.get("max_tokens", 0)
+
+    @staticmethod
+    def _unused_output_tokens(kwargs, message) -> int:
+        if message is None:
+            return 0
+        used = getattr(message.usage, "output_tokens", 0)
+        received = sum(len(getattr(block, "text", "")) for block in message.content) // 4
+        if getattr(message, "stop_reason", None) is None:
+            # Closed before message_delta, so usage still holds message_start's count
+            used = max(used, received)
+        elif not used:
+            used = received
+        return kwargs.get("max_tokens", 0) - used
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, kwargs):
+        self._check_circuit()
+        self.waiting += 1
+        try:
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(self._estimate_tokens(kwargs))
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        self.requests += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    async def _with_retries(self, start, kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_circuit()
+            if attempt > 1:
+                # Every retry is a new request against the API's limits, so charge it too
+                await self.request_bucket.acquire(1)
+                await self.token_bucket.acquire(self._estimate_tokens(kwargs))
+            started = time.monotonic()
+            try:
+                result = await start()
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == self.max_attempts:
+                    self._record_failure()
+                    raise
+                self.retries += 1
+                delay = self._backoff_delay(attempt, e)
+                logger.warning(
+                    f"Anthropic request failed ({type(e).__name__}), retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+            else:
+                self._record_success(time.monotonic() - started)
+                return result
+
+    async def create(self, **kwargs):
+        async with self._slot(kwargs):
+            message = await self._with_retries(
+                lambda: self.client.messages.create(**kwargs), kwargs
+            )
+        self.token_bucket.refund(self._unused_output_tokens(kwargs, message))
+        return message
+
+    @contextlib.asynccontextmanager
+    async def stream(self, **kwargs):
+        async with self._slot(kwargs):
+
+            async def start():
+                manager = self.client.messages.stream(**kwargs)
+                return manager, await manager.__aenter__()
+
+            manager, stream = await self._with_retries(start, kwargs)
+            try:
+                yield stream
+            except RETRYABLE_API_ERRORS:
+                self._record_failure()
+                raise
+            finally:
+                await manager.__aexit__(None, None, None)
+                try:
+                    snapshot = stream.current_message_snapshot
+                except AssertionError:
+                    # Closed before any event was read, so there is nothing to measure
+                    snapshot = None
+                self.token_bucket.refund(self._unused_output_tokens(kwargs, snapshot))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": self.waiting,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected_while_open": self.rejected,
+            "circuit_open": self.opened_at is not None,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
+
+
+__anthropic = AnthropicGateway(
+    AsyncClient(
+        api_key=config["ANTHROPIC"]["API_TOKEN"],
+        base_url=config["ANTHROPIC"].get("BASE_URL"),
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=config.getint("ANTHROPIC", "MAX_CONNECTIONS", fallback=20),
+                max_keepalive_connections=config.getint(
+                    "ANTHROPIC", "MAX_CONNECTIONS", fallback=20
+                ),
+            )
+        ),
+    ),
+    max_concurrency=config.getint("ANTHROPIC", "MAX_CONCURRENT_REQUESTS", fallback=8),
+    requests_per_minute=config.getint("ANTHROPIC", "REQUESTS_PER_MINUTE", fallback=50),
+    tokens_per_minute=config.getint("ANTHROPIC", "TOKENS_PER_MINUTE", fallback=80000),
+    max_attempts=config.getint("ANTHROPIC", "MAX_ATTEMPTS", fallback=5),
+    breaker_threshold=config.getint("ANTHROPIC", "BREAKER_THRESHOLD", fallback=5),
+    breaker_cooldown=config.getfloat("ANTHROPIC", "BREAKER_COOLDOWN", fallback=30.0),
+)
 
 app = fastapi.FastAPI()
 
@@ -39,11 +292,186 @@ app.add_middleware(
     allow_headers=["*"],
 )
 job_store = {}
+inflight_jobs = {}
+stage_stats = {}
+job_listeners = {}
+last_job_events = {}
+attempt_stats = {"completed_jobs": 0, "attempts": 0}
+estimate_stats = {"samples": 0, "actual_to_predicted": 0.0}
+faststart_stats = {"checked": 0, "remuxed": 0, "moov_offset_before": 0, "moov_offset_after": 0}
 
 MAX_TOKENS = 3000
-CONTEXT_LIMIT = 5
+CHAT_TOKEN_BUDGET = config.getint("CHAT", "TOKEN_BUDGET", fallback=4000)
+CHAT_MAX_MESSAGES = config.getint("CHAT", "MAX_MESSAGES", fallback=50)
+CHAT_MAX_SESSIONS = config.getint("CHAT", "MAX_SESSIONS", fallback=1000)
 MAX_RETRIES = 3  
-chat_context = []
+TERMINAL_STATUSES = {"completed", "failed", "expired"}
+EVENT_KEEPALIVE = 15
+JOBS_PAGE_LIMIT = 500
+RENDER_WORKERS = config.getint("SCHEDULER", "RENDER_WORKERS", fallback=os.cpu_count() or 1)
+GENERATION_WORKERS = config.getint("SCHEDULER", "GENERATION_WORKERS", fallback=8)
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+PROGRESS_CHUNK_INTERVAL = 20
+RENDER_TIMEOUT = 300
+DRY_RUN_TIMEOUT = config.getint("RENDER", "DRY_RUN_TIMEOUT", fallback=60)
+FORK_SERVER = config.getboolean("RENDER", "FORK_SERVER", fallback=True)
+FORK_SERVER_STARTUP_TIMEOUT = 120
+PARALLEL_SEGMENTS = config.getint("RENDER", "PARALLEL_SEGMENTS", fallback=os.cpu_count() or 1)
+MIN_SEGMENT_ANIMATIONS = config.getint("RENDER", "MIN_SEGMENT_ANIMATIONS", fallback=4)
+CODE_INFO_CACHE_SIZE = 512
+TEX_CACHE_DIR = "media/shared/Tex"
+TEX_SCRATCH_DIR = "media/shared/tmp"
+TEX_CACHE_MB = config.getint("TEX", "CACHE_MB", fallback=256)
+TEX_PRECOMPILE_WORKERS = config.getint(
+    "TEX", "PRECOMPILE_WORKERS", fallback=min(4, os.cpu_count() or 1)
+)
+PARTIAL_CACHE_DIR = "media/shared/partial_movies"
+PARTIAL_CACHE_MB = config.getint("RENDER", "PARTIAL_CACHE_MB", fallback=2048)
+MANIM_CONFIG_FILE = "media/shared/manim.cfg"
+QUALITY_DIRS = {"l": "480p15", "m": "720p30", "h": "1080p60", "p": "1440p60", "k": "2160p60"}
+PREVIEW_QUALITY = "l"
+FINAL_QUALITY = config.get("RENDER", "FINAL_QUALITY", fallback="h")
+FINAL_RENDER_TIMEOUT = config.getint("RENDER", "FINAL_RENDER_TIMEOUT", fallback=1800)
+SCRATCH_DIR = config.get("WORKSPACE", "SCRATCH_DIR", fallback="/dev/shm")
+SCRATCH_MB = config.getint("WORKSPACE", "SCRATCH_MB", fallback=1024)
+DISK_SCRATCH_DIR = "media/scratch"
+SCRATCH_PARTIAL_CACHE_DIR = os.path.join(SCRATCH_DIR, "manimation_partial_movies")
+# SCRATCH_DIR is usually tmpfs, so its partial cache gets a small quota of its own
+SCRATCH_PARTIAL_CACHE_MB = config.getint("WORKSPACE", "PARTIAL_CACHE_MB", fallback=256)
+CODE_DIR = "code"
+BLOB_DIR = "videos/blobs"
+GC_INTERVAL = config.getint("STORAGE", "GC_INTERVAL_SECONDS", fallback=600)
+# Artifact classes collected by the storage GC: where they live, which entries count,
+# the byte quota and the idle time after which they go. 0 disables a limit. Videos are
+# aged by when /video last served them, everything else by its last write or use.
+# Job videos are links to shared blobs, so each is charged its share of the blob.
+STORAGE_CLASSES = {
+    "videos": {
+        "directories": ["videos"],
+        "pattern": "*.mp4",
+        "quota_mb": config.getint("STORAGE", "VIDEO_QUOTA_MB", fallback=10240),
+        "ttl_hours": config.getint("STORAGE", "VIDEO_TTL_HOURS", fallback=720),
+        "by_access": True,
+        "shared": True,
+    },
+    "code": {
+        "directories": [CODE_DIR],
+        "pattern": "*.py",
+        "quota_mb": config.getint("STORAGE", "CODE_QUOTA_MB", fallback=100),
+        "ttl_hours": config.getint("STORAGE", "CODE_TTL_HOURS", fallback=720),
+        "by_access": False,
+    },
+    "partial_movies": {
+        "directories": [PARTIAL_CACHE_DIR],
+        "pattern": "*.mp4",
+        "quota_mb": PARTIAL_CACHE_MB,
+        "ttl_hours": config.getint("STORAGE", "PARTIAL_TTL_HOURS", fallback=168),
+        "by_access": False,
+    },
+    "scratch_partial_movies": {
+        "directories": [SCRATCH_PARTIAL_CACHE_DIR],
+        "pattern": "*.mp4",
+        "quota_mb": SCRATCH_PARTIAL_CACHE_MB,
+        "ttl_hours": config.getint("STORAGE", "PARTIAL_TTL_HOURS", fallback=168),
+        "by_access": False,
+    },
+    "tex": {
+        "directories": [TEX_CACHE_DIR],
+        "pattern": "*",
+        "quota_mb": TEX_CACHE_MB,
+        "ttl_hours": config.getint("STORAGE", "TEX_TTL_HOURS", fallback=720),
+        "by_access": False,
+    },
+    "workspaces": {
+        "directories": [
+            os.path.join(SCRATCH_DIR, "manimation"),
+            DISK_SCRATCH_DIR,
+            "media/videos",
+        ],
+        "pattern": "*",
+        "quota_mb": 0,
+        "ttl_hours": config.getint("STORAGE", "WORKSPACE_TTL_HOURS", fallback=6),
+        "by_access": False,
+    },
+}
+gc_stats = {"runs": 0, "last_run": None, "expired_jobs": 0, "reclaimed_bytes": {}, "removed": {}}
+gc_task = None
+# Held while a blob is published or linked and while an orphan is removed, so the GC
+# never deletes a blob between its appearance and the job link that references it
+blob_lock = threading.RLock()
+CORRECTION_TOKEN_BUDGET = config.getint("CORRECTION", "TOKEN_BUDGET", fallback=800)
+MAX_TRACEBACK_FRAMES = 3
+TRACEBACK_SUMMARY_LINES = 6
+MAX_CANDIDATES = config.getint("CANDIDATES", "MAX_CANDIDATES", fallback=4)
+MIN_CANDIDATE_TOKENS = config.getint("CANDIDATES", "MIN_CANDIDATE_TOKENS", fallback=1000)
+CANDIDATE_MODELS = ["claude-3-opus-latest", "claude-3-5-sonnet-20240620"]
+CANDIDATE_TEMPERATURES = [0.2, 0.5, 0.8]
+chat_sessions = OrderedDict()
+background_renders = set()
+animation_counts = OrderedDict()
+partial_movie_index = OrderedDict()
+precompiled_tex = OrderedDict()
+
+
+def tex_worker_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=TEX_PRECOMPILE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+tex_executor = tex_worker_pool()
+
+CACHE_DIR = "cache"
+TOPIC_CACHE_SIZE = config.getint("CACHE", "TOPIC_CACHE_SIZE", fallback=256)
+CODE_CACHE_SIZE = config.getint("CACHE", "CODE_CACHE_SIZE", fallback=512)
+TIMEOUT_ERROR = "Manim rendering timed out after {timeout} seconds"
+COST_LOG = os.path.join(CACHE_DIR, "render_costs.jsonl")
+MIN_RENDER_TIMEOUT = 60
+MAX_RENDER_TIMEOUT = config.getint("RENDER", "MAX_TIMEOUT", fallback=900)
+RENDER_TIMEOUT_FACTOR = 4
+RENDER_BUDGET_SECONDS = config.getint("RENDER", "BUDGET_SECONDS", fallback=600)
+# Cost model for estimate_render_cost, in CPU-seconds at 854x480; calibrate against COST_LOG
+QUALITY_SETTINGS = {
+    "l": (854, 480, 15),
+    "m": (1280, 720, 30),
+    "h": (1920, 1080, 60),
+    "p": (2560, 1440, 60),
+    "k": (3840, 2160, 60),
+}
+SECONDS_PER_FRAME = 0.02
+SURFACE_FRAME_SECONDS = 0.05
+UPDATER_FRAME_SECONDS = 0.01
+PLAY_OVERHEAD_SECONDS = 0.3
+TEXT_OBJECT_SECONDS = 1.0
+UNKNOWN_LOOP_ITERATIONS = 3
+SURFACE_CLASSES = {"Surface", "ParametricSurface", "Sphere", "Torus", "Cylinder", "Cone"}
+
+THREE_D_SCENES = {"ThreeDScene", "SpecialThreeDScene"}
+THREE_D_ONLY_METHODS = {
+    "set_camera_orientation",
+    "move_camera",
+    "begin_ambient_camera_rotation",
+    "stop_ambient_camera_rotation",
+    "add_fixed_in_frame_mobjects",
+}
+KNOWN_BAD_CALLS = {
+    "move_camera": "use set_camera_orientation instead of move_camera in ThreeDScene",
+}
+TEX_CLASSES = {"MathTex", "Tex", "SingleStringMathTex"}
+TEXT_CLASSES = TEX_CLASSES | {"Text", "MarkupText", "Paragraph"}
+# Anything that depends on wall-clock frame time or unseeded randomness renders
+# differently when earlier animations are skipped, so such scenes render serially.
+SPLIT_UNSAFE_NAMES = {
+    "random",
+    "rng",
+    "default_rng",
+    "time",
+    "renderer",
+    "begin_ambient_camera_rotation",
+    "begin_3dillusion_camera_rotation",
+    "turn_animation_into_updater",
+    "cycle_animation",
+}
 
 BASE_PROMPT = """You are a math visualizer and you need to explain {topic} by generating manim video code. Return ONLY the Python code for Manim with no explanations, comments or anything else.
 
@@ -68,21 +496,39 @@ class YourVisualizationName(ThreeDScene):
 ```
 """
 
-ERROR_CORRECTION_PROMPT = """The Manim code you provided resulted in the following error:
+ERROR_CORRECTION_PROMPT = """Rendering the code you provided failed with the following error:
 
 ```
 {error}
 ```
 
-Please fix the code to address this specific error. Common issues include:
+Please fix the code to address this specific error with the smallest change that works. Common issues include:
 1. Using move_camera instead of set_camera_orientation in ThreeDScene
 2. Incorrect inheritance (2D vs 3D scene)
 3. Syntax errors in LaTeX expressions
 4. References to undefined variables or objects
 
-Provide ONLY the complete, corrected code with no explanations:
+Reply ONLY with one or more edits in this exact format, with no explanations:
+
+<<<<<<< SEARCH
+lines copied exactly from your previous code
+=======
+the replacement lines
+>>>>>>> REPLACE
+
+If the fix needs a substantial rewrite, reply instead with the complete corrected code in a single ```python block.
+"""
+
+PATCH_MISMATCH_PROMPT = """These SEARCH blocks do not match your previous code exactly, so the edits could not be applied:
+
+```
+{searches}
+```
+
+Reply with the complete corrected code in a single ```python block, with no explanations.
 """
 
+CORRECTION_SYSTEM_PROMPT = "You are a math visualization expert who fixes Manim code. Only respond with SEARCH/REPLACE edits or complete, working Python code for Manim, no explanations. Your code should NOT use special Unicode characters, use ASCII alternatives instead."
 
 class VisualizationStatus(BaseModel):
     job_id: str
@@ -93,60 +539,1385 @@ class VisualizationStatus(BaseModel):
 
 class MathVisualizationRequest(BaseModel):
     topic: str
+    priority: Literal["high", "normal", "low"] = "normal"
+    tiers: List[Literal["preview", "final"]] = ["preview", "final"]
+    session_id: Optional[str] = None
+    force_render: bool = False
+    candidates: int = 1
+    max_candidate_tokens: Optional[int] = None
 
 
 class ChatMessage(BaseModel):
     message: str
+    session_id: Optional[str] = None
+
+
+class RenderCache:
+    """Size-bounded LRU mapping persisted as JSON so entries survive restarts."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = OrderedDict(json.load(f))
+            logger.info(f"Loaded {len(self.entries)} cache entries from {self.path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache file {self.path}: {str(e)}")
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving cache file {self.path}: {str(e)}")
+
+    def get(self, key: str, is_valid=None):
+        """Return the entry for key, dropping it first if is_valid rejects it."""
+        entry = self.entries.get(key)
+        if entry is not None and is_valid is not None and not is_valid(entry):
+            self.discard(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value: dict):
+        value["last_used"] = time.time()
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            logger.info(f"Evicted cache entry: {evicted_key}")
+        self._save()
+
+    def discard(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self._save()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+topic_cache = RenderCache(os.path.join(CACHE_DIR, "topic_cache.json"), TOPIC_CACHE_SIZE)
+code_cache = RenderCache(os.path.join(CACHE_DIR, "code_cache.json"), CODE_CACHE_SIZE)
+
+
+def normalize_topic(topic: str) -> str:
+    """Fold case, punctuation and whitespace so equivalent topics share a cache key."""
+    topic = re.sub(r"[^\w\s]", " ", topic.casefold())
+    return " ".join(topic.split())
+
+
+def job_snapshot(job_id: str) -> dict:
+    job = job_store[job_id]
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "progress_details": job.get("progress_details") or "",
+        "video_path": job.get("video_path") or "",
+        "error": job.get("error") or "",
+        "queue_position": job.get("queue_position"),
+        "quality": job.get("quality"),
+    }
+
+
+def publish_job_event(job_id: str):
+    """Push the job's current state to every open /events stream for it."""
+    listeners = job_listeners.get(job_id)
+    if not listeners:
+        return
+
+    snapshot = job_snapshot(job_id)
+    if snapshot == last_job_events.get(job_id):
+        return
+    last_job_events[job_id] = snapshot
+
+    for queue in listeners:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(snapshot)
+
+
+def update_job(job_id: str, **fields):
+    """Apply fields to a job and mirror them onto any jobs attached to it."""
+    job = job_store.get(job_id)
+    if job is None:
+        return
+
+    for target_id in [job_id] + job.get("followers", []):
+        if target_id in job_store:
+            job_store[target_id].update(fields)
+            publish_job_event(target_id)
+
+
+def record_timing(job_id: str, stage: str, seconds: float):
+    """Record how long a pipeline stage took, per job and in the server-wide totals."""
+    job = job_store.get(job_id)
+    if job is not None:
+        timings = dict(job.get("timings", {}))
+        timings[stage] = timings.get(stage, []) + [round(seconds, 3)]
+        update_job(job_id, timings=timings)
+
+    stats = stage_stats.setdefault(stage, {"count": 0, "total_seconds": 0.0})
+    stats["count"] += 1
+    stats["total_seconds"] += seconds
+
+
+class StageScheduler:
+    """Admits at most `limit` jobs into a pipeline stage at once. Waiting jobs are
+    served by priority class, then shortest estimated render first, then first in,
+    first out, and each waiting job's queue position is kept up to date in job_store."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def _publish_positions(self):
+        for position, (_, _, _, job_id, _) in enumerate(sorted(self.waiters), start=1):
+            update_job(
+                job_id,
+                queue_stage=self.name,
+                queue_position=position,
+                progress_details=f"Waiting for a {self.name} slot (position {position})",
+            )
+
+    def _release(self):
+        while self.waiters:
+            _, _, _, job_id, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                self._publish_positions()
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job_id: str, priority: int = PRIORITY_CLASSES["normal"]):
+        started = time.monotonic()
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            cost = job_store.get(job_id, {}).get("estimated_cost") or 0.0
+            entry = (priority, cost, next(self.counter), job_id, future)
+            heapq.heappush(self.waiters, entry)
+            self._publish_positions()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                elif entry in self.waiters:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                    self._publish_positions()
+                raise
+            record_timing(job_id, f"{self.name}_queue", time.monotonic() - started)
+            update_job(job_id, queue_stage=None, queue_position=None)
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        return {"active": self.active, "limit": self.limit, "waiting": len(self.waiters)}
+
+
+generation_scheduler = StageScheduler("generation", GENERATION_WORKERS)
+render_scheduler = StageScheduler("render", RENDER_WORKERS)
+
+
+class ForkServerError(Exception):
+    """Raised when the pre-warmed Manim worker is not running or dies mid-render."""
+
+
+class ManimFailure(str):
+    """Error text of a Manim run that exited non-zero on the script itself. Only these
+    are cached as known-bad code; timeouts, signals, missing output and ffmpeg or
+    server errors are plain strings and may succeed on another try."""
+
+
+class ManimForkServer:
+    """Client for manim_worker.py, a long-lived process that has already imported
+    manim and forks a fresh child with its own module namespace for every render."""
+
+    def __init__(self, script: str):
+        self.script = script
+        self.process = None
+        self.reader = None
+        self.pending = {}
+        self.counter = itertools.count()
+
+    @property
+    def available(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            self.script,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        try:
+            line = await asyncio.wait_for(
+                self.process.stdout.readline(), timeout=FORK_SERVER_STARTUP_TIMEOUT
+            )
+            if not line or not json.loads(line).get("ready"):
+                raise ForkServerError("Manim worker exited during start-up")
+        except Exception:
+            await self.stop()
+            raise
+        self.reader = asyncio.create_task(self._read_replies())
+        logger.info(f"Manim fork server started (pid {self.process.pid})")
+
+    async def stop(self):
+        if self.reader:
+            self.reader.cancel()
+        if self.available:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+    async def _read_replies(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                break
+            reply = json.loads(line)
+            future = self.pending.get(reply.get("id"))
+            if future is not None and "returncode" in reply and not future.done():
+                future.set_result(reply["returncode"])
+
+        logger.warning("Manim fork server exited, falling back to subprocess renders")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ForkServerError("Manim worker exited mid-render"))
+
+    async def run(self, args: List[str], cwd: str, timeout: float):
+        """Render in a forked worker and return (returncode, stdout, stderr).
+        The worker is killed if the timeout expires or the caller is cancelled."""
+        if not self.available:
+            raise ForkServerError("Manim worker is not running")
+
+        request_id = next(self.counter)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+
+        with tempfile.TemporaryDirectory() as scratch:
+            stdout_path = os.path.join(scratch, "stdout")
+            stderr_path = os.path.join(scratch, "stderr")
+            request = {
+                "id": request_id,
+                "args": args,
+                "cwd": os.path.abspath(cwd),
+                "stdout": stdout_path,
+                "stderr": stderr_path,
+            }
+            try:
+                self.process.stdin.write(json.dumps(request).encode() + b"\n")
+                await self.process.stdin.drain()
+                returncode = await asyncio.wait_for(future, timeout=timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if self.available:
+                    self.process.stdin.write(json.dumps({"kill": request_id}).encode() + b"\n")
+                raise
+            except (BrokenPipeError, ConnectionResetError) as e:
+                raise ForkServerError(f"Manim worker is not accepting requests: {e}")
+            finally:
+                self.pending.pop(request_id, None)
+
+            with open(stdout_path, encoding="utf-8", errors="replace") as f:
+                stdout = f.read()
+            with open(stderr_path, encoding="utf-8", errors="replace") as f:
+                stderr = f.read()
+        return returncode, stdout, stderr
+
+
+fork_server = ManimForkServer(os.path.join(os.path.dirname(os.path.abspath(__file__)), "manim_worker.py"))
+
+
+def normalize_code(code: str) -> str:
+    """Canonical form of generated code with comments, formatting and class names removed."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        lines = [line.split("#", 1)[0].strip() for line in code.splitlines()]
+        return "\n".join(line for line in lines if line)
+
+    renames = {}
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            renames[node.name] = f"_Class{len(renames)}"
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and node.name in renames:
+            node.name = renames[node.name]
+        elif isinstance(node, ast.Name) and node.id in renames:
+            node.id = renames[node.id]
+
+    return ast.unparse(tree)
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(normalize_code(code).encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def module_exports(module_name: str):
+    """Names a star import of module_name would bind, or None if it can't be imported."""
+    try:
+        module = importlib.import_module(module_name)
+    except Exception as e:
+        logger.warning(f"Cannot import {module_name} for pre-flight checks: {str(e)}")
+        return None
+
+    names = getattr(module, "__all__", None)
+    if names is None:
+        names = [name for name in dir(module) if not name.startswith("_")]
+    return frozenset(names)
+
+
+def bound_names(tree: ast.AST):
+    """Every name the code binds anywhere, or None if a star import can't be resolved."""
+    names = set(dir(builtins))
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.name != "*":
+                    names.add(alias.asname or alias.name)
+                    continue
+                exports = module_exports(node.module)
+                if exports is None:
+                    return None
+                names.update(exports)
+
+    return names
+
+
+class TexPrecompiled(Exception):
+    """Stops a Tex mobject's construction once its SVG is in the shared cache."""
+
+
+def compile_tex_expression(kind: str, strings: List[str]) -> Optional[str]:
+    """Runs in a tex_executor worker: build manim's `kind` mobject from strings far enough
+    to compile its LaTeX into TEX_CACHE_DIR, and return the SVG file name.
+    Compilation happens in a private scratch directory and the SVG is moved into the
+    shared cache atomically, so concurrent jobs never see a partial file."""
+    import manim
+    from manim.mobject.text import tex_mobject
+    from manim.utils import tex_file_writing
+
+    os.makedirs(TEX_CACHE_DIR, exist_ok=True)
+    os.makedirs(TEX_SCRATCH_DIR, exist_ok=True)
+    compiled = []
+
+    def to_svg_file(expression, environment=None, tex_template=None):
+        tex_file = tex_file_writing.generate_tex_file(expression, environment, tex_template)
+        target = os.path.join(TEX_CACHE_DIR, tex_file.with_suffix(".svg").name)
+        if os.path.exists(target):
+            os.utime(target)
+        else:
+            svg_file = tex_file_writing.tex_to_svg_file(expression, environment, tex_template)
+            os.replace(svg_file, target)
+        compiled.append(os.path.basename(target))
+        raise TexPrecompiled()
+
+    with tempfile.TemporaryDirectory(dir=TEX_SCRATCH_DIR) as scratch:
+        manim.config.tex_dir = scratch
+        tex_mobject.tex_to_svg_file = to_svg_file
+        try:
+            getattr(manim, kind)(*strings)
+        except TexPrecompiled:
+            pass
+    return compiled[0] if compiled else None
+
+
+def tex_literals(code: str) -> List[tuple]:
+    """Unique (class name, strings) pairs for Tex/MathTex calls made only of string literals."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+
+    literals = []
+    for node in ast.walk(tree):
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in TEX_CLASSES
+            and node.args
+            and all(
+                isinstance(arg, ast.Constant) and isinstance(arg.value, str)
+                for arg in node.args
+            )
+        ):
+            continue
+        literal = (node.func.id, tuple(arg.value for arg in node.args))
+        if literal not in literals:
+            literals.append(literal)
+    return literals
+
+
+def select_evictions(entries: list, quota_mb: int, ttl_hours: float, now: float) -> list:
+    """Pick the (last_used, size, path) entries to delete: everything idle for longer
+    than ttl_hours, then the least recently used until the rest fits in quota_mb.
+    A limit of 0 is ignored."""
+    evicted = []
+    kept = []
+    for entry in sorted(entries):
+        if ttl_hours and now - entry[0] > ttl_hours * 3600:
+            evicted.append(entry)
+        else:
+            kept.append(entry)
+
+    if quota_mb:
+        total = sum(size for _, size, _ in kept)
+        for entry in kept:
+            if total <= quota_mb * 1024 * 1024:
+                break
+            evicted.append(entry)
+            total -= entry[1]
+    return evicted
+
+
+def trim_cache_dir(directory: str, max_mb: int):
+    """Evict the least recently used files until directory fits in max_mb."""
+    try:
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(directory)
+            if entry.is_file()
+        ]
+    except FileNotFoundError:
+        return
+
+    for _, _, path in select_evictions(entries, max_mb, 0, time.time()):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def scratch_root() -> str:
+    """SCRATCH_DIR while it has SCRATCH_MB free, otherwise a directory on disk."""
+    try:
+        if shutil.disk_usage(SCRATCH_DIR).free >= SCRATCH_MB * 1024 * 1024:
+            return os.path.join(SCRATCH_DIR, "manimation")
+    except OSError:
+        pass
+    return os.path.abspath(DISK_SCRATCH_DIR)
+
+
+def create_workspace(name: str) -> str:
+    """Create an empty scratch directory for one attempt and return its absolute path.
+    The script and everything manim writes for it stay inside, so cleanup is one rmtree."""
+    root = scratch_root()
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{name}_", dir=root)
+
+
+def media_dir(file_path: str, media_id: str) -> str:
+    """The --media_dir of a run for media_id, next to the script in its workspace."""
+    return os.path.join(os.path.dirname(file_path), media_id)
+
+
+def save_code_artifact(job_id: str, code: str) -> str:
+    """Keep a job's final script in CODE_DIR once its workspace is gone."""
+    os.makedirs(CODE_DIR, exist_ok=True)
+    path = os.path.join(CODE_DIR, f"{job_id}.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(code)
+    return path
+
+
+def seed_tex_dir(media_path: str, svg_names: List[str]):
+    """Hard-link precompiled SVGs into a render's own Tex directory. Each job keeps its
+    links, so evicting an entry from the shared cache never breaks a running render."""
+    if not svg_names:
+        return
+    tex_dir = os.path.join(media_path, "Tex")
+    os.makedirs(tex_dir, exist_ok=True)
+    for name in svg_names:
+        target = os.path.join(tex_dir, name)
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(os.path.join(TEX_CACHE_DIR, name), target)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            shutil.copyfile(os.path.join(TEX_CACHE_DIR, name), target)
+
+
+def ensure_manim_config() -> str:
+    """Write the manim.cfg passed to every run and return its absolute path. Manim's own
+    partial movie cleanup is turned off because the shared partial cache is trimmed here."""
+    if not os.path.exists(MANIM_CONFIG_FILE):
+        os.makedirs(os.path.dirname(MANIM_CONFIG_FILE), exist_ok=True)
+        with open(MANIM_CONFIG_FILE, "w", encoding="utf-8") as f:
+            f.write("[CLI]\nmax_files_cached = -1\n")
+    return os.path.abspath(MANIM_CONFIG_FILE)
+
+
+def quality_dir(file_path: str, quality: str = PREVIEW_QUALITY) -> str:
+    """The directory manim names after the pixel height and frame rate of a run, such as
+    480p15. Literal config.pixel_height / config.frame_rate assignments at module or
+    class level run on import and override the quality flag, so they are honoured."""
+    _, height, fps = QUALITY_SETTINGS[quality]
+    try:
+        with open(file_path, encoding="utf-8") as f:
+            body = list(ast.parse(f.read()).body)
+    except (OSError, SyntaxError):
+        return QUALITY_DIRS[quality]
+
+    while body:
+        node = body.pop(0)
+        if isinstance(node, ast.ClassDef):
+            body.extend(node.body)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if (
+                    isinstance(target, ast.Attribute)
+                    and isinstance(target.value, ast.Name)
+                    and target.value.id == "config"
+                ):
+                    if target.attr == "frame_rate":
+                        fps = literal_number(node.value, fps)
+                    elif target.attr == "pixel_height":
+                        height = literal_number(node.value, height)
+    return f"{int(height)}p{fps:g}"
+
+
+def partial_movie_dir(
+    media_id: str, file_path: str, scene: str, quality: str = PREVIEW_QUALITY
+) -> str:
+    """Where manim keeps the per-animation movies of scene for a run under media_id."""
+    return os.path.join(
+        media_dir(file_path, media_id),
+        "videos",
+        Path(file_path).stem,
+        quality_dir(file_path, quality),
+        "partial_movie_files",
+        scene,
+    )
+
 
+def partial_cache_dir(file_path: str) -> str:
+    """The shared partial movie cache on the same filesystem as file_path's workspace,
+    so seeding and publishing are hard links: one under SCRATCH_DIR for workspaces
+    there, PARTIAL_CACHE_DIR for workspaces on disk."""
+    scratch = os.path.join(os.path.abspath(SCRATCH_DIR), "manimation") + os.sep
+    if os.path.abspath(file_path).startswith(scratch):
+        return SCRATCH_PARTIAL_CACHE_DIR
+    return PARTIAL_CACHE_DIR
 
-def append_chat(role: str, message: str):
-    while len(chat_context) >= CONTEXT_LIMIT:
-        chat_context.pop(0)
 
-    chat_context.append({"role": role, "content": [{"type": "text", "text": message}]})
+PARTIAL_MOVIE_LIST_RE = re.compile(r"^file '(?:file:)?(.+)'$", re.MULTILINE)
+
+
+def used_partial_movies(partial_dir: str) -> List[str]:
+    """Names of the partial movies a finished run combined, from the concat list manim
+    writes next to them: the ones it rendered and the cached ones it skipped."""
+    try:
+        with open(os.path.join(partial_dir, "partial_movie_file_list.txt"), encoding="utf-8") as f:
+            listing = f.read()
+    except FileNotFoundError:
+        return []
+    return [os.path.basename(path) for path in PARTIAL_MOVIE_LIST_RE.findall(listing)]
+
+
+def seed_partial_movies(partial_dir: str, names, cache_dir: str = PARTIAL_CACHE_DIR):
+    """Hard-link the cached partial movies among names into a run's partial movie
+    directory. Manim names partial movies by a hash of the play() call, so any animation
+    that was rendered before, by this job or another, is found and skipped. The run holds
+    its own link or copy of each file, so evicting a cache entry never breaks it."""
+    os.makedirs(partial_dir, exist_ok=True)
+    for name in names:
+        source = os.path.join(cache_dir, name)
+        target = os.path.join(partial_dir, name)
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(source, target)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            try:
+                shutil.copyfile(source, target)
+            except FileNotFoundError:
+                continue
+
+
+def publish_partial_movies(partial_dir: str, cache_dir: str = PARTIAL_CACHE_DIR) -> List[str]:
+    """Add the partial movies a successful run used to the shared cache, mark the cached
+    ones as recently used, and trim the cache to its quota. A movie only appears
+    in the cache complete: it is linked in, or copied beside it and renamed into place.
+    Returns the names the run used."""
+    names = used_partial_movies(partial_dir)
+    if not names:
+        return []
+    os.makedirs(cache_dir, exist_ok=True)
+
+    for name in names:
+        source = os.path.join(partial_dir, name)
+        target = os.path.join(cache_dir, name)
+        try:
+            if os.path.exists(target):
+                os.utime(target)
+            else:
+                os.link(source, target)
+        except (FileExistsError, FileNotFoundError):
+            pass
+        except OSError:
+            staged = f"{target}.{uuid.uuid4().hex}.tmp"
+            try:
+                shutil.copyfile(source, staged)
+                os.replace(staged, target)
+            except OSError as e:
+                logger.warning(f"Could not publish partial movie {name}: {str(e)}")
+                with contextlib.suppress(OSError):
+                    os.remove(staged)
+
+    quota_mb = SCRATCH_PARTIAL_CACHE_MB if cache_dir == SCRATCH_PARTIAL_CACHE_DIR else PARTIAL_CACHE_MB
+    trim_cache_dir(cache_dir, quota_mb)
+    return names
+
+
+def remember_partial_movies(scene: str, names: List[str]):
+    """Record the partial movies a render of scene used, so the next render of a scene by
+    that name, such as a retry or another segment, is seeded with just those."""
+    known = partial_movie_index.pop(scene, OrderedDict())
+    for name in names:
+        known.pop(name, None)
+        known[name] = True
+    while len(known) > CODE_INFO_CACHE_SIZE:
+        known.popitem(last=False)
+    partial_movie_index[scene] = known
+    while len(partial_movie_index) > CODE_INFO_CACHE_SIZE:
+        partial_movie_index.popitem(last=False)
+
+
+async def precompile_tex(code: str, job_id: Optional[str] = None):
+    """Compile the code's Tex/MathTex literals in parallel into the shared cache and
+    remember their SVG names, so every render of this code starts with them in place."""
+    global tex_executor
+    key = code_hash(code)
+    if key in precompiled_tex:
+        return
+
+    literals = tex_literals(code)
+    if not literals:
+        return
+
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    try:
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(tex_executor, compile_tex_expression, kind, list(strings))
+                for kind, strings in literals
+            ),
+            return_exceptions=True,
+        )
+    except BrokenProcessPool as e:
+        results = [e]
+    if any(isinstance(result, BrokenProcessPool) for result in results):
+        logger.warning("LaTeX pre-compilation workers died, starting a new pool")
+        tex_executor.shutdown(wait=False, cancel_futures=True)
+        tex_executor = tex_worker_pool()
+        return
+
+    svg_names = [name for name in results if isinstance(name, str)]
+    failures = [result for result in results if isinstance(result, BaseException)]
+    if failures:
+        logger.info(f"{len(failures)} of {len(literals)} Tex literals failed to precompile: {failures[0]}")
+
+    precompiled_tex[key] = svg_names
+    while len(precompiled_tex) > CODE_INFO_CACHE_SIZE:
+        precompiled_tex.popitem(last=False)
+    record_timing(job_id, "tex_precompile", time.monotonic() - started)
+    await loop.run_in_executor(None, trim_cache_dir, TEX_CACHE_DIR, TEX_CACHE_MB)
+
+
+def latex_error(tex: str, text_mode: bool) -> Optional[str]:
+    """Describe the first structural problem in a LaTeX string, if any."""
+    if not tex.isascii():
+        return "contains non-ASCII characters"
+
+    depth = 0
+    dollars = 0
+    i = 0
+    while i < len(tex):
+        char = tex[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth < 0:
+                return "has an unmatched '}'"
+        elif char == "$":
+            dollars += 1
+        i += 1
+
+    if depth > 0:
+        return f"has {depth} unclosed '{{'"
+    if text_mode and dollars % 2:
+        return "has an unmatched '$'"
+    if len(re.findall(r"\\left(?![a-zA-Z])", tex)) != len(
+        re.findall(r"\\right(?![a-zA-Z])", tex)
+    ):
+        return "has unmatched \\left/\\right delimiters"
+    if sorted(re.findall(r"\\begin\{([^}]*)\}", tex)) != sorted(
+        re.findall(r"\\end\{([^}]*)\}", tex)
+    ):
+        return "has unmatched \\begin/\\end environments"
+    return None
+
+
+def scene_classes(tree: ast.Module) -> list:
+    """(class node, base names) for every Scene subclass defined at module level,
+    including subclasses of other scenes in the same file, in source order."""
+    scenes = []
+    known = set()
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        base_names = {
+            base.id if isinstance(base, ast.Name) else getattr(base, "attr", "")
+            for base in node.bases
+        }
+        if any(name.endswith("Scene") or name in known for name in base_names):
+            scenes.append((node, base_names))
+            known.add(node.name)
+    return scenes
+
+
+def class_methods(node: ast.ClassDef) -> set:
+    return {
+        child.name
+        for child in node.body
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))
+    }
+
+
+def scene_lineage(scenes: list) -> Dict[str, tuple]:
+    """(methods, base names) of each scene from scene_classes, including everything it
+    inherits from scenes defined earlier in the same file."""
+    lineage = {}
+    for scene, base_names in scenes:
+        methods = class_methods(scene)
+        bases = set(base_names)
+        for name in base_names:
+            if name in lineage:
+                methods |= lineage[name][0]
+                bases |= lineage[name][1]
+        lineage[scene.name] = (methods, bases)
+    return lineage
+
+
+def scene_names(code: str) -> List[str]:
+    """Names of the scenes in code that define or inherit construct(), in source order."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+    scenes = scene_classes(tree)
+    lineage = scene_lineage(scenes)
+    return [
+        scene.name for scene, _ in scenes if "construct" in lineage[scene.name][0]
+    ]
+
+
+def preflight_check(code: str) -> Optional[str]:
+    """Statically validate generated scene code before it is rendered.
+    Returns a description of the problems found, or None if the code looks renderable."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return f"SyntaxError: {e.msg} (line {e.lineno})\n{(e.text or '').rstrip()}"
+
+    problems = []
+
+    scenes = scene_classes(tree)
+    if not scenes:
+        problems.append("Expected at least one Scene or ThreeDScene subclass, found none")
+
+    subclassed = {name for _, base_names in scenes for name in base_names}
+    lineage = scene_lineage(scenes)
+    for scene, _ in scenes:
+        methods, base_names = lineage[scene.name]
+        if "construct" not in methods and scene.name not in subclassed:
+            problems.append(f"Scene class {scene.name} has no construct() method")
+
+        is_3d = bool(base_names & THREE_D_SCENES)
+        for node in ast.walk(scene):
+            if not (
+                isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name)
+                and node.func.value.id == "self"
+            ):
+                continue
+            method = node.func.attr
+            if is_3d and method in KNOWN_BAD_CALLS:
+                problems.append(f"Line {node.lineno}: {KNOWN_BAD_CALLS[method]}")
+            elif not is_3d and method in THREE_D_ONLY_METHODS and method not in methods:
+                problems.append(
+                    f"Line {node.lineno}: self.{method} requires {scene.name} to inherit from ThreeDScene"
+                )
+
+    names = bound_names(tree)
+    if names is not None:
+        undefined = {}
+        for node in ast.walk(tree):
+            if (
+                isinstance(node, ast.Name)
+                and isinstance(node.ctx, ast.Load)
+                and node.id not in names
+            ):
+                undefined.setdefault(node.id, node.lineno)
+        for name, lineno in undefined.items():
+            problems.append(f"Line {lineno}: name '{name}' is not defined")
+
+    for node in ast.walk(tree):
+        if not (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in TEX_CLASSES
+        ):
+            continue
+        strings = [
+            arg.value
+            for arg in node.args
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str)
+        ]
+        if not strings:
+            continue
+        error = latex_error(" ".join(strings), text_mode=node.func.id == "Tex")
+        if error:
+            problems.append(f"Line {node.lineno}: {node.func.id} expression {error}")
+
+    if not problems:
+        return None
+    return "Pre-flight check failed:\n" + "\n".join(f"- {p}" for p in problems)
+
+
+def split_hazard(code: str) -> Optional[str]:
+    """Reason a scene can't be rendered as independent animation segments, or None
+    if every segment would start from the same state a serial render reaches."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return f"SyntaxError: {e.msg}"
+
+    for node in ast.walk(tree):
+        name = None
+        if isinstance(node, ast.Name):
+            name = node.id
+        elif isinstance(node, ast.Attribute):
+            name = node.attr
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = [alias.name for alias in node.names] + [getattr(node, "module", None)]
+            if any(module and module.split(".")[0] in SPLIT_UNSAFE_NAMES for module in modules):
+                return f"line {node.lineno} imports a time or randomness module"
+        if name in SPLIT_UNSAFE_NAMES:
+            return f"line {node.lineno} uses {name}"
+
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr == "add_updater"
+            and node.args
+            and not (
+                isinstance(node.args[0], ast.Lambda) and len(node.args[0].args.args) == 1
+            )
+        ):
+            return f"line {node.lineno} adds an updater that may depend on dt"
+
+    return None
+
+
+def literal_number(node: Optional[ast.AST], default: float) -> float:
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return float(node.value)
+    return default
+
+
+def loop_iterations(loop: ast.AST) -> int:
+    """Iteration count of a for loop over a literal sequence or range(), else a guess."""
+    if isinstance(loop, ast.For):
+        iterable = loop.iter
+        if isinstance(iterable, (ast.List, ast.Tuple, ast.Set)):
+            return len(iterable.elts)
+        if (
+            isinstance(iterable, ast.Call)
+            and isinstance(iterable.func, ast.Name)
+            and iterable.func.id == "range"
+            and iterable.args
+            and all(
+                isinstance(arg, ast.Constant) and isinstance(arg.value, int)
+                for arg in iterable.args
+            )
+        ):
+            return len(range(*(arg.value for arg in iterable.args)))
+    return UNKNOWN_LOOP_ITERATIONS
+
+
+def estimate_render_cost(code: str, quality: str = PREVIEW_QUALITY) -> Optional[dict]:
+    """Predict a script's render cost from its AST without running it. Animated seconds
+    come from play() run_time and wait() durations, multiplied through loops. Each 3D
+    surface and updater call site adds a per-frame cost and each text object a fixed
+    cost, scaled by the frame rate and resolution of the quality or of any literal
+    camera config in the script."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    width, height, fps = QUALITY_SETTINGS[quality]
+    counts = {"play_calls": 0, "animated_seconds": 0.0, "surfaces": 0, "updaters": 0, "text_objects": 0}
+
+    def visit(node: ast.AST, multiplier: int):
+        nonlocal width, height, fps
+        if isinstance(node, (ast.For, ast.While)):
+            multiplier *= loop_iterations(node)
+
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if (
+                    isinstance(target, ast.Attribute)
+                    and isinstance(target.value, ast.Name)
+                    and target.value.id == "config"
+                ):
+                    if target.attr == "frame_rate":
+                        fps = literal_number(node.value, fps)
+                    elif target.attr == "pixel_width":
+                        width = literal_number(node.value, width)
+                    elif target.attr == "pixel_height":
+                        height = literal_number(node.value, height)
+
+        if isinstance(node, ast.Call):
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+            if name == "play" and isinstance(func, ast.Attribute):
+                counts["play_calls"] += multiplier
+                counts["animated_seconds"] += multiplier * literal_number(keywords.get("run_time"), 1.0)
+            elif name == "wait" and isinstance(func, ast.Attribute):
+                duration = node.args[0] if node.args else keywords.get("duration")
+                counts["animated_seconds"] += multiplier * literal_number(duration, 1.0)
+            elif name in SURFACE_CLASSES:
+                counts["surfaces"] += 1
+            elif name in ("always_redraw", "add_updater"):
+                counts["updaters"] += 1
+            elif name in TEXT_CLASSES:
+                counts["text_objects"] += multiplier
+
+        for child in ast.iter_child_nodes(node):
+            visit(child, multiplier)
+
+    visit(tree, 1)
+
+    frame_seconds = (
+        SECONDS_PER_FRAME
+        + counts["surfaces"] * SURFACE_FRAME_SECONDS
+        + counts["updaters"] * UPDATER_FRAME_SECONDS
+    ) * (width * height) / (854 * 480)
+    cpu_seconds = (
+        counts["animated_seconds"] * fps * frame_seconds
+        + counts["play_calls"] * PLAY_OVERHEAD_SECONDS
+        + counts["text_objects"] * TEXT_OBJECT_SECONDS
+    )
+    return {
+        **counts,
+        "animated_seconds": round(counts["animated_seconds"], 2),
+        "quality": quality,
+        "cpu_seconds": round(cpu_seconds, 1),
+    }
+
+
+def render_timeout(estimate: Optional[dict], ceiling: int = MAX_RENDER_TIMEOUT) -> int:
+    """Per-job render timeout: a generous multiple of the predicted CPU time, within bounds."""
+    if not estimate:
+        return RENDER_TIMEOUT
+    return int(min(ceiling, max(MIN_RENDER_TIMEOUT, estimate["cpu_seconds"] * RENDER_TIMEOUT_FACTOR)))
+
+
+def budget_error(estimate: Optional[dict]) -> Optional[str]:
+    """Correction feedback for a script predicted to cost more than RENDER_BUDGET_SECONDS.
+    The budget is checked against the PREVIEW_QUALITY estimate."""
+    if not estimate or estimate["cpu_seconds"] <= RENDER_BUDGET_SECONDS:
+        return None
+    return (
+        f"Render cost check failed: the scene is estimated at about {estimate['cpu_seconds']:.0f} "
+        f"CPU-seconds, over the budget of {RENDER_BUDGET_SECONDS}. It has "
+        f"{estimate['animated_seconds']:.0f} seconds of animation in {estimate['play_calls']} "
+        f"play() calls, {estimate['surfaces']} 3D surfaces, {estimate['updaters']} updaters and "
+        f"{estimate['text_objects']} text objects. Simplify the scene: use fewer or shorter "
+        "animations, fewer or coarser 3D surfaces, and fewer updaters."
+    )
+
+
+def log_render_cost(
+    job_id: str, estimate: Optional[dict], stage: str, render_seconds: List[float]
+):
+    """Append a job's predicted render time and the time its manim runs held render slots
+    to COST_LOG for calibration. Segments and scenes rendered in parallel are summed, so
+    the comparison is with the CPU time the estimate predicts, not the wall clock."""
+    timings = job_store.get(job_id, {}).get("timings", {}).get(stage)
+    if not estimate or not render_seconds:
+        return
+
+    actual = round(sum(render_seconds), 3)
+    if estimate["cpu_seconds"] > 0:
+        estimate_stats["samples"] += 1
+        estimate_stats["actual_to_predicted"] += actual / estimate["cpu_seconds"]
+    try:
+        os.makedirs(os.path.dirname(COST_LOG), exist_ok=True)
+        with open(COST_LOG, "a", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "job_id": job_id,
+                        "stage": stage,
+                        "logged_at": time.time(),
+                        "estimate": estimate,
+                        "actual_seconds": actual,
+                        "parallel_runs": len(render_seconds),
+                        "wall_seconds": timings[-1] if timings else None,
+                    }
+                )
+                + "\n"
+            )
+    except OSError as e:
+        logger.warning(f"Could not write render cost log: {e}")
+
+
+def chat_history(session_id: str) -> deque:
+    """Return the message history for a session, evicting the least recently used
+    sessions beyond CHAT_MAX_SESSIONS."""
+    history = chat_sessions.get(session_id)
+    if history is None:
+        history = deque(maxlen=CHAT_MAX_MESSAGES)
+        chat_sessions[session_id] = history
+    chat_sessions.move_to_end(session_id)
+
+    while len(chat_sessions) > CHAT_MAX_SESSIONS:
+        chat_sessions.popitem(last=False)
+    return history
+
+
+def message_tokens(message: dict) -> int:
+    return sum(len(block["text"]) for block in message["content"]) // 4 + 1
+
+
+def append_chat(session_id: str, role: str, message: str):
+    """Add a message to a session and drop the oldest ones beyond CHAT_TOKEN_BUDGET."""
+    history = chat_history(session_id)
+    history.append({"role": role, "content": [{"type": "text", "text": message}]})
+
+    total = sum(message_tokens(m) for m in history)
+    while len(history) > 1 and total > CHAT_TOKEN_BUDGET:
+        total -= message_tokens(history.popleft())
+    while history and history[0]["role"] != "user":
+        history.popleft()
+
+
+def extract_code_block(text: str) -> Optional[str]:
+    """Return the body of the first closed code fence in text, preferring python fences."""
+    code_blocks = re.findall(r"```python\n(.*?)```", text, re.DOTALL)
+    if not code_blocks:
+        code_blocks = re.findall(r"```\n(.*?)```", text, re.DOTALL)
+    return code_blocks[0] if code_blocks else None
+
+
+async def stream_code(
+    job_id: Optional[str] = None, stop_at_fence: bool = True, **kwargs
+) -> str:
+    """Stream a completion and stop reading as soon as its first code fence closes.
+    Returns the fenced code, or the whole response if it never contained a fence.
+    With stop_at_fence off, the whole response is read and returned unchanged."""
+    text = ""
+    chunks = 0
+
+    async with __anthropic.stream(**kwargs) as stream:
+        async for chunk in stream.text_stream:
+            text += chunk
+            chunks += 1
+
+            if chunks % PROGRESS_CHUNK_INTERVAL == 0:
+                update_job(
+                    job_id,
+                    progress_details=f"Receiving code from Claude ({chunks} chunks)",
+                )
+
+            if stop_at_fence and "```" in text[-(len(chunk) + 3) :]:
+                code = extract_code_block(text)
+                if code is not None:
+                    logger.info(f"Code block closed after {chunks} chunks, ending stream")
+                    return code
+
+    if stop_at_fence:
+        logger.info(f"Stream finished after {chunks} chunks without a closed code block")
+    return text
+
+
+TRACEBACK_FRAME_RE = re.compile(r'manim_code_[\w-]+\.py(?:", line |:)(\d+)')
+PREFLIGHT_LINE_RE = re.compile(r"\b[Ll]ine (\d+)")
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+LOG_PATH_COLUMN_RE = re.compile(r"\S+\.py:\d+")
+PLAYED_ANIMATIONS_RE = re.compile(r"\bRendered (\w+(?: \w+)*?) Played (\d+) animations?\b")
+PATCH_BLOCK_RE = re.compile(
+    r"<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE", re.DOTALL
+)
+
+
+def played_animations(output: str) -> Dict[str, int]:
+    """Read each scene's animation count from manim's log. Its RichHandler wraps the
+    message in a narrow column: "Rendered X" and "Played N animations" land on separate
+    lines, the source path column sits between them, and long scene names are folded
+    across lines. Path columns are dropped and whitespace collapsed before matching."""
+    text = " ".join(LOG_PATH_COLUMN_RE.sub(" ", ANSI_ESCAPE_RE.sub("", output)).split())
+    return {
+        name.replace(" ", ""): int(count)
+        for name, count in PLAYED_ANIMATIONS_RE.findall(text)
+    }
+
+
+def distill_traceback(
+    error: str, code: str, token_budget: int = CORRECTION_TOKEN_BUDGET
+) -> str:
+    """Reduce a render error to its final exception lines plus the generated
+    source lines it points at, trimmed to roughly token_budget tokens."""
+    error = ANSI_ESCAPE_RE.sub("", error)
+    lines = [line.strip(" \t│╭╮╰╯─┃━") for line in error.splitlines()]
+    lines = [line for line in lines if line]
+
+    if error.startswith("Pre-flight check failed"):
+        summary = lines
+        line_numbers = PREFLIGHT_LINE_RE.findall(error)
+    else:
+        summary = lines[-TRACEBACK_SUMMARY_LINES:]
+        line_numbers = TRACEBACK_FRAME_RE.findall(error)
+
+    frames = []
+    for number in reversed(line_numbers):
+        if int(number) not in frames:
+            frames.insert(0, int(number))
+        if len(frames) >= MAX_TRACEBACK_FRAMES:
+            break
+
+    code_lines = code.splitlines()
+    excerpt = []
+    for lineno in frames:
+        for n in range(max(1, lineno - 1), min(len(code_lines), lineno + 1) + 1):
+            marker = ">" if n == lineno else " "
+            excerpt.append(f"{marker} {n:4d} | {code_lines[n - 1]}")
+        excerpt.append("")
+
+    budget = token_budget * 4
+    while summary and len("\n".join(summary + excerpt)) > budget:
+        if len(summary) > 1:
+            summary.pop(0)
+        elif excerpt:
+            excerpt.pop(0)
+        else:
+            summary[0] = summary[0][-budget:]
+            break
+
+    distilled = "\n".join(summary)
+    if excerpt:
+        distilled += "\n\nOffending lines in your code:\n" + "\n".join(excerpt).rstrip()
+    return distilled
+
+
+def apply_patch(code: str, response: str) -> Optional[str]:
+    """Apply SEARCH/REPLACE edits from response to code.
+    Returns None if there are no edits or any of them doesn't match."""
+    blocks = PATCH_BLOCK_RE.findall(response)
+    if not blocks:
+        return None
+
+    for search, replace in blocks:
+        if search in code:
+            code = code.replace(search, replace, 1)
+            continue
+
+        stripped = "\n".join(line.rstrip() for line in code.splitlines())
+        search = "\n".join(line.rstrip() for line in search.splitlines())
+        if not search or search not in stripped:
+            return None
+        code = stripped.replace(search, replace, 1)
+
+    return code
+
+
+def unmatched_searches(code: str, response: str) -> List[str]:
+    """The SEARCH texts in response that are not found in code, ignoring trailing spaces."""
+    stripped = "\n".join(line.rstrip() for line in code.splitlines())
+    return [
+        search
+        for search, _ in PATCH_BLOCK_RE.findall(response)
+        if "\n".join(line.rstrip() for line in search.splitlines()) not in stripped
+    ]
+
+
+def count_correction(job_id: Optional[str], mode: str):
+    job = job_store.get(job_id)
+    if job is None:
+        return
+
+    corrections = dict(job.get("corrections", {}))
+    corrections[mode] = corrections.get(mode, 0) + 1
+    update_job(job_id, corrections=corrections)
 
 
 async def generate_manim_code(
-    topic: str, error_message: str = None, retry_count: int = 0
+    topic: str,
+    error_message: str = None,
+    retry_count: int = 0,
+    job_id: str = None,
+    model: str = "claude-3-opus-latest",
+    temperature: float = 0.2,
+    max_tokens: int = MAX_TOKENS,
+    previous_code: str = None,
+    session_id: str = None,
 ):
     """Generate Manim code using Claude 3.5 for the given math topic.
-    If error_message is provided, it will be used to correct previous code."""
+    If error_message and previous_code are provided, the failing code and a distilled
+    traceback are sent back so the model can patch it instead of starting over."""
     try:
         logger.info(f"Requesting Manim code for topic: {topic} (Retry: {retry_count})")
 
-        if error_message:
-            prompt = ERROR_CORRECTION_PROMPT.format(error=error_message)
+        if error_message and previous_code:
+            prompt = ERROR_CORRECTION_PROMPT.format(
+                error=distill_traceback(error_message, previous_code)
+            )
             logger.info("Using error correction prompt")
-        else:
-            prompt = BASE_PROMPT.format(topic=topic)
 
-        message = await __anthropic.messages.create(
-            model="claude-3-opus-latest",
-            max_tokens=MAX_TOKENS,
-            temperature=0.2,
-            system="You are a math visualization expert who creates flawless Manim code. Only respond with complete, working Python code for Manim, no explanations. Your code should NOT use special Unicode characters, use ASCII alternatives instead.",
-            messages=[{"role": "user", "content": prompt}],
-        )
+            messages = [
+                {"role": "user", "content": BASE_PROMPT.format(topic=topic)},
+                {"role": "assistant", "content": previous_code},
+                {"role": "user", "content": prompt},
+            ]
+            # Edits may each sit in their own fence, so read the response to the end
+            response = await stream_code(
+                job_id,
+                stop_at_fence=False,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system=CORRECTION_SYSTEM_PROMPT,
+                messages=messages,
+            )
 
-        code = message.content[0].text
+            code = apply_patch(previous_code, response)
+            if code is not None:
+                logger.info("Applied patch from error correction response")
+                count_correction(job_id, "patch")
+            elif PATCH_BLOCK_RE.search(response):
+                # Edits that don't apply are not a script; ask for the whole file instead
+                logger.info("Patch did not match the previous code, asking for the full code")
+                searches = unmatched_searches(previous_code, response) or [
+                    search for search, _ in PATCH_BLOCK_RE.findall(response)
+                ]
+                code = await stream_code(
+                    job_id,
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=CORRECTION_SYSTEM_PROMPT,
+                    messages=messages
+                    + [
+                        {"role": "assistant", "content": response},
+                        {
+                            "role": "user",
+                            "content": PATCH_MISMATCH_PROMPT.format(
+                                searches="\n\n".join(searches)
+                            ),
+                        },
+                    ],
+                )
+                if PATCH_BLOCK_RE.search(code):
+                    code = ""
+                count_correction(job_id, "rewrite")
+            else:
+                code = extract_code_block(response) or response
+                count_correction(job_id, "rewrite")
+        else:
+            prompt = BASE_PROMPT.format(topic=topic)
 
-        if "```python" in code:
-            code_blocks = re.findall(r"```python\n(.*?)```", code, re.DOTALL)
-            if code_blocks:
-                code = code_blocks[0]
-        elif "```" in code:
-            code_blocks = re.findall(r"```\n(.*?)```", code, re.DOTALL)
-            if code_blocks:
-                code = code_blocks[0]
+            code = await stream_code(
+                job_id,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system="You are a math visualization expert who creates flawless Manim code. Only respond with complete, working Python code for Manim, no explanations. Your code should NOT use special Unicode characters, use ASCII alternatives instead.",
+                messages=[{"role": "user", "content": prompt}],
+            )
 
         if len(code.splitlines()) < 10 or "Here's" in code or "I'll" in code:
             logger.info(
                 "Response contains explanations instead of pure code. Trying again..."
             )
 
-            message = await __anthropic.messages.create(
+            code = await stream_code(
+                job_id,
                 model="claude-3-5-sonnet-20240620",
-                max_tokens=MAX_TOKENS,
+                max_tokens=max_tokens,
                 temperature=0.1,
                 system="You MUST ONLY output complete Python code for Manim. NO explanations, NO comments, NO conversation. Do NOT use special Unicode characters, use ASCII alternatives instead.",
                 messages=[
@@ -157,222 +1928,1107 @@ async def generate_manim_code(
                 ],
             )
 
-            code = message.content[0].text
-
-            if "```python" in code:
-                code_blocks = re.findall(r"```python\n(.*?)```", code, re.DOTALL)
-                if code_blocks:
-                    code = code_blocks[0]
-            elif "```" in code:
-                code_blocks = re.findall(r"```\n(.*?)```", code, re.DOTALL)
-                if code_blocks:
-                    code = code_blocks[0]
-
         if "ThreeDScene" in code and "move_camera" in code:
             code = code.replace("move_camera", "set_camera_orientation")
 
         if "from manim import" not in code and "import manim" not in code:
             code = "from manim import *\n" + code
 
-        append_chat("user", prompt)
-        append_chat("assistant", code)
+        if session_id:
+            append_chat(session_id, "user", prompt)
+            append_chat(session_id, "assistant", code)
         return code
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Error generating Manim code: {str(e)}")
         raise Exception(f"Failed to generate Manim code: {str(e)}")
 
 
-async def run_manim_command(file_path: str, job_id: str, timeout: int = 300):
-    """Run the Manim command with a timeout and return success status and error message if any."""
+async def run_manim_subprocess(cmd: str, cwd: str, timeout: float):
+    """Run a Manim shell command and return (returncode, stdout, stderr).
+    The process is killed if the timeout expires or the caller is cancelled."""
+    process = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd
+    )
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        process.kill()
+        raise
+    return process.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+
+
+async def run_manim_command(
+    file_path: str,
+    job_id: str,
+    timeout: int = 300,
+    dry_run: bool = False,
+    animations: Optional[str] = None,
+    scene: Optional[str] = None,
+    quality: str = PREVIEW_QUALITY,
+):
+    """Run the Manim command with a timeout and return success status and error message if any.
+    With dry_run, every scene's construct() is executed without writing any frames or video,
+    and the number of animations each played is remembered for splitting the render later.
+    Otherwise only the named scene is rendered, and animations is a manim
+    "-n first,last" range to render only part of it, at the given manim quality letter.
+    Rendered videos land at render_output_path(job_id, file_path, quality).
+    Runs in the pre-warmed fork server when it is up, otherwise in a fresh subprocess."""
     try:
         python_exe = sys.executable
-        output_dir = f"media/videos/"
-        os.makedirs(output_dir, exist_ok=True)
+        workspace = os.path.dirname(file_path) or "."
+        script = os.path.basename(file_path)
 
-        cmd = f'"{python_exe}" -m manim -pql ../../{file_path} --media_dir {job_id}'
-
-        if sys.platform == "win32":
-            cmd = f'"{python_exe}" -m manim -pql ..\\..\\{file_path} --media_dir {job_id}'
-
-        logger.info(f"Running command: {cmd}")
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=output_dir
-        )
+        if dry_run:
+            flags = "--dry_run -a -ql"
+        elif animations:
+            flags = f"-q{quality} -n {animations}"
+        else:
+            flags = f"-pq{quality}"
+        if not dry_run:
+            # Name the output after the media dir so its path is known in advance
+            flags += f" -o {job_id}"
+        config_file = ensure_manim_config()
+        scene_args = [scene] if scene and not dry_run else []
+        scene_arg = f" {scene}" if scene_args else ""
+        cmd = f'"{python_exe}" -m manim {flags} --config_file "{config_file}" {script}{scene_arg} --media_dir {job_id}'
+
+        with open(file_path, encoding="utf-8") as f:
+            key = code_hash(f.read())
+        seed_tex_dir(media_dir(file_path, job_id), precompiled_tex.get(key, []))
+
+        partial_dir = None
+        if scene_args:
+            partial_dir = partial_movie_dir(job_id, file_path, scene, quality)
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                seed_partial_movies,
+                partial_dir,
+                list(partial_movie_index.get(scene, ())),
+                partial_cache_dir(file_path),
+            )
 
         try:
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(), timeout=timeout
-            )
-            stdout = stdout.decode("utf-8")
-            stderr = stderr.decode("utf-8")
+            started = time.monotonic()
+            backend = "fork_server"
+            try:
+                args = (
+                    flags.split()
+                    + ["--config_file", config_file, script]
+                    + scene_args
+                    + ["--media_dir", job_id]
+                )
+                logger.info(f"Running in fork server: manim {' '.join(args)}")
+                returncode, stdout, stderr = await fork_server.run(args, workspace, timeout)
+            except ForkServerError as e:
+                if FORK_SERVER and sys.platform != "win32":
+                    logger.info(f"Fork server unavailable ({e}), using a subprocess")
+                backend = "subprocess"
+                logger.info(f"Running command: {cmd}")
+                returncode, stdout, stderr = await run_manim_subprocess(
+                    cmd, workspace, timeout
+                )
+            stage = f"manim_{backend}" + ("_dry_run" if dry_run else "")
+            record_timing(job_id, stage, time.monotonic() - started)
 
-            if job_id in job_store:
-                job_store[job_id]["status"] = "processing_video"
+            if not dry_run and not animations:
+                update_job(job_id, status="processing_video")
 
-            if process.returncode != 0:
+            if returncode != 0:
                 logger.error(f"Manim error: {stderr}")
-                return False, stderr
+                # A negative code means the process was killed, not that the script failed
+                return False, ManimFailure(stderr) if returncode > 0 else stderr
 
             logger.info(f"Manim output: {stdout}")
+            if partial_dir:
+                used = await asyncio.get_running_loop().run_in_executor(
+                    None, publish_partial_movies, partial_dir, partial_cache_dir(file_path)
+                )
+                remember_partial_movies(scene, used)
+            if dry_run:
+                played = played_animations(stdout + "\n" + stderr)
+                if played:
+                    animation_counts[key] = played
+                    while len(animation_counts) > CODE_INFO_CACHE_SIZE:
+                        animation_counts.popitem(last=False)
             return True, None
 
         except asyncio.TimeoutError:
-            process.kill()
-            error_msg = f"Manim rendering timed out after {timeout} seconds"
+            error_msg = TIMEOUT_ERROR.format(timeout=timeout)
             logger.error(error_msg)
             return False, error_msg
 
+        except asyncio.CancelledError:
+            logger.info(f"Manim run cancelled for {job_id}")
+            raise
+
     except Exception as e:
         logger.error(f"Error running Manim: {str(e)}")
         return False, str(e)
 
 
-async def find_and_move_video(job_id: str):
-    """Find the generated video file and move it to the videos directory.
+async def concat_videos(video_paths: List[str], output_path: str):
+    """Join MP4 files with ffmpeg's concat demuxer without re-encoding.
     Returns (success, error_message)."""
+    list_path = f"{output_path}.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in video_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
     try:
-        job_output_dir = Path(f"media/videos/{job_id}")
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+            "-i", list_path, "-c", "copy", output_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+    finally:
+        os.remove(list_path)
+
+    if process.returncode != 0:
+        return False, f"ffmpeg concat failed: {stderr.decode('utf-8', errors='replace')}"
+    return True, None
+
+
+def mp4_box_offsets(path: str) -> Dict[str, int]:
+    """Byte offset of the first top-level MP4 box of each type."""
+    offsets = {}
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size = int.from_bytes(header[:4], "big")
+            if size == 1:
+                size = int.from_bytes(header[8:16], "big")
+            elif size == 0:
+                size = file_size - offset
+            if size < 8:
+                break
+            offsets.setdefault(header[4:8].decode("latin-1"), offset)
+            offset += size
+    return offsets
+
+
+async def faststart_remux(job_id: str, video_path: str):
+    """Move the moov atom in front of the media data without re-encoding, so players can
+    start before the whole file has arrived. Files that already start with it are left
+    alone. The moov offset before and after, which is how many bytes a player must
+    fetch before its first frame, is recorded per job and in faststart_stats."""
+    offsets = mp4_box_offsets(video_path)
+    if "moov" not in offsets or "mdat" not in offsets:
+        return
+    before = after = offsets["moov"]
+
+    if offsets["moov"] > offsets["mdat"]:
+        started = time.monotonic()
+        staged_path = f"{video_path}.faststart.mp4"
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-loglevel", "error", "-i", video_path,
+                "-c", "copy", "-map", "0", "-movflags", "+faststart", staged_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            _, stderr = await process.communicate()
+            if process.returncode == 0:
+                os.replace(staged_path, video_path)
+                after = mp4_box_offsets(video_path).get("moov", before)
+                faststart_stats["remuxed"] += 1
+            else:
+                logger.warning(
+                    f"Faststart remux failed for job {job_id}: "
+                    f"{stderr.decode('utf-8', errors='replace')}"
+                )
+        except OSError as e:
+            logger.warning(f"Faststart remux unavailable for job {job_id}: {str(e)}")
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(staged_path)
+        record_timing(job_id, "faststart", time.monotonic() - started)
+
+    faststart_stats["checked"] += 1
+    faststart_stats["moov_offset_before"] += before
+    faststart_stats["moov_offset_after"] += after
+    update_job(job_id, moov_offset={"before": before, "after": after})
+
+
+def segment_ranges(animation_count: int) -> List[str]:
+    """Split animations 0..animation_count-1 into manim "-n" ranges, one per segment.
+    The last range is left open so it always runs to the end of the scene."""
+    segments = min(PARALLEL_SEGMENTS, animation_count // max(1, MIN_SEGMENT_ANIMATIONS))
+    if segments < 2:
+        return []
+
+    size, extra = divmod(animation_count, segments)
+    ranges = []
+    first = 0
+    for index in range(segments):
+        last = first + size + (index < extra) - 1
+        ranges.append(f"{first},{last}" if index < segments - 1 else f"{first}")
+        first = last + 1
+    return ranges
+
+
+def render_output_path(media_id: str, file_path: str, quality: str = PREVIEW_QUALITY) -> str:
+    """Where a run with --media_dir media_id and -o media_id writes its video. When the
+    script sets its resolution or frame rate in a way quality_dir can't read, the one
+    video of that name in the run's own media directory is used instead."""
+    videos_dir = os.path.join(media_dir(file_path, media_id), "videos", Path(file_path).stem)
+    output_path = os.path.join(videos_dir, quality_dir(file_path, quality), f"{media_id}.mp4")
+    if not os.path.exists(output_path):
+        found = glob.glob(os.path.join(glob.escape(videos_dir), "*", f"{media_id}.mp4"))
+        if len(found) == 1:
+            return found[0]
+    return output_path
+
+
+async def render_segment(
+    file_path: str,
+    segment_id: str,
+    animations: str,
+    timeout: int,
+    scene: Optional[str] = None,
+    quality: str = PREVIEW_QUALITY,
+):
+    """Render one animation range and return (success, error_message, video_path)."""
+    success, error_message = await run_manim_command(
+        file_path,
+        segment_id,
+        timeout=timeout,
+        animations=animations,
+        scene=scene,
+        quality=quality,
+    )
+    if not success:
+        return False, error_message, None
 
-        await asyncio.sleep(1)
+    video_path = render_output_path(segment_id, file_path, quality)
+    if not os.path.exists(video_path):
+        return False, f"Segment {animations} produced no video", None
+    return True, None, video_path
+
+
+async def render_scene(
+    file_path: str,
+    job_id: str,
+    code: str,
+    priority: int = PRIORITY_CLASSES["normal"],
+    timeout: int = RENDER_TIMEOUT,
+    scene: Optional[str] = None,
+    media_id: Optional[str] = None,
+    stage: str = "render",
+    quality: str = PREVIEW_QUALITY,
+    render_seconds: Optional[list] = None,
+):
+    """Render one scene of a validated script to render_output_path(media_id), spreading
+    its animations across render slots when the dry run counted enough of them and
+    nothing in the scene depends on what was skipped. The time each manim run held a
+    render slot is appended to render_seconds.
+    Returns (success, error_message, video_path)."""
+    if render_seconds is None:
+        render_seconds = []
+    media_id = media_id or job_id
+    count = animation_counts.get(code_hash(code), {}).get(scene)
+    ranges = segment_ranges(count) if count else []
+    hazard = split_hazard(code) if ranges else None
+    if hazard:
+        logger.info(f"Rendering {scene} for job {job_id} serially: {hazard}")
+
+    if not ranges or hazard:
+        async with render_scheduler.slot(job_id, priority):
+            started = time.monotonic()
+            success, error_message = await run_manim_command(
+                file_path, media_id, timeout=timeout, scene=scene, quality=quality
+            )
+            render_seconds.append(time.monotonic() - started)
+            record_timing(job_id, stage, render_seconds[-1])
+        output_path = render_output_path(media_id, file_path, quality)
+        if success and not os.path.exists(output_path):
+            return False, f"Manim finished without writing {output_path}", None
+        return success, error_message, output_path if success else None
+
+    logger.info(
+        f"Rendering {scene} for job {job_id} as {len(ranges)} segments of {count} animations"
+    )
+    started = time.monotonic()
+    segment_ids = [f"{media_id}_part{index}" for index in range(len(ranges))]
+
+    async def render_in_slot(segment_id, animations):
+        async with render_scheduler.slot(job_id, priority):
+            segment_started = time.monotonic()
+            result = await render_segment(
+                file_path, segment_id, animations, timeout, scene, quality
+            )
+            render_seconds.append(time.monotonic() - segment_started)
+            record_timing(job_id, "render_segment", render_seconds[-1])
+            return result
+
+    tasks = [
+        asyncio.create_task(render_in_slot(segment_id, animations))
+        for segment_id, animations in zip(segment_ids, ranges)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            success, error_message, _ = await finished
+            if not success:
+                return False, error_message, None
+
+        output_path = render_output_path(media_id, file_path, quality)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        success, error_message = await concat_videos(
+            [task.result()[2] for task in tasks], output_path
+        )
+        record_timing(job_id, stage, time.monotonic() - started)
+        return success, error_message, output_path if success else None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for segment_id in segment_ids:
+            shutil.rmtree(media_dir(file_path, segment_id), ignore_errors=True)
+
+
+async def render_scenes(
+    file_path: str,
+    job_id: str,
+    code: str,
+    priority: int = PRIORITY_CLASSES["normal"],
+    quality: str = PREVIEW_QUALITY,
+    media_id: Optional[str] = None,
+    timeout: int = RENDER_TIMEOUT,
+    stage: str = "render",
+    render_seconds: Optional[list] = None,
+):
+    """Render every scene in a validated script concurrently, then join them in source
+    order into render_output_path(media_id). The time each manim run held a render slot
+    is appended to render_seconds, so parallel work can be costed as a whole.
+    Returns (success, error_message, video_path)."""
+    media_id = media_id or job_id
+    scenes = scene_names(code)
+    if len(scenes) <= 1:
+        return await render_scene(
+            file_path,
+            job_id,
+            code,
+            priority,
+            timeout,
+            scene=scenes[0] if scenes else None,
+            media_id=media_id,
+            stage=stage,
+            quality=quality,
+            render_seconds=render_seconds,
+        )
 
-        if job_output_dir.exists():
-            video_files = list(job_output_dir.glob("*.mp4"))
-            logger.info(f"Found {len(video_files)} videos in {job_output_dir}")
-        else:
-            video_files = []
-            logger.warning(f"Directory not found: {job_output_dir}")
-
-        if not video_files:
-            for root, dirs, files in os.walk("media/videos"):
-                for file in files:
-                    if file.endswith(".mp4"):
-                        filepath = os.path.join(root, file)
-                        logger.info(f"Found MP4: {filepath}")
-                        video_files.append(Path(filepath))
-
-            if not video_files:
-                video_files = list(Path(".").glob(f"**/*.mp4"))
-                logger.info(f"Deep search found {len(video_files)} MP4 files")
-
-        if not video_files:
-            return False, f"Video file not found for job_id: {job_id}"
-
-        if len(video_files) > 1:
-            video_files.sort(key=lambda x: os.path.getctime(str(x)), reverse=True)
+    logger.info(f"Rendering {len(scenes)} scenes for job {job_id}: {', '.join(scenes)}")
+    started = time.monotonic()
+    scene_media_ids = [f"{media_id}_scene{index}" for index in range(len(scenes))]
+    scene_timings = {}
+
+    async def render_timed(scene, scene_media_id):
+        scene_started = time.monotonic()
+        result = await render_scene(
+            file_path, job_id, code, priority, timeout,
+            scene=scene, media_id=scene_media_id, stage="render_scene", quality=quality,
+            render_seconds=render_seconds,
+        )
+        scene_timings[scene] = round(time.monotonic() - scene_started, 3)
+        update_job(job_id, scene_timings=dict(scene_timings))
+        return result
+
+    tasks = [
+        asyncio.create_task(render_timed(scene, scene_media_id))
+        for scene, scene_media_id in zip(scenes, scene_media_ids)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            success, error_message, _ = await finished
+            if not success:
+                return False, error_message, None
+
+        output_path = render_output_path(media_id, file_path, quality)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        success, error_message = await concat_videos(
+            [task.result()[2] for task in tasks], output_path
+        )
+        record_timing(job_id, stage, time.monotonic() - started)
+        return success, error_message, output_path if success else None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for scene_media_id in scene_media_ids:
+            shutil.rmtree(media_dir(file_path, scene_media_id), ignore_errors=True)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_video(job_id: str, video_path: str) -> str:
+    """Point videos/{job_id}.mp4 at an already stored video with a hard link, replacing
+    any earlier version in one atomic rename. Returns the job's video path."""
+    dest_video = f"videos/{job_id}.mp4"
+    with blob_lock:
+        if os.path.exists(dest_video) and os.path.samefile(video_path, dest_video):
+            return dest_video
+
+        staged_video = f"{dest_video}.tmp"
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(staged_video)
+        try:
+            os.link(video_path, staged_video)
+        except OSError:
+            shutil.copyfile(video_path, staged_video)
+        os.replace(staged_video, dest_video)
+    return dest_video
+
+
+async def publish_video(job_id: str, source_video: str):
+    """Remux a finished render to faststart, store it once under its content hash in
+    BLOB_DIR and link it to videos/{job_id}.mp4. A render identical to one already
+    stored only adds a link.
+    Returns (success, video_path or error_message)."""
+    loop = asyncio.get_running_loop()
+    staged_blob = None
+    try:
+        await faststart_remux(job_id, source_video)
+        sha = await loop.run_in_executor(None, file_sha256, source_video)
+        blob_path = os.path.join(BLOB_DIR, f"{sha}.mp4")
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        staged_blob = f"{blob_path}.{job_id}.tmp"
+        try:
+            os.replace(source_video, staged_blob)
+        except OSError:
+            # Different filesystem: copy next to the blob first
+            await loop.run_in_executor(None, shutil.copyfile, source_video, staged_blob)
+
+        with blob_lock:
+            if os.path.exists(blob_path):
+                logger.info(f"Video for job {job_id} matches stored blob {sha}")
+                os.remove(staged_blob)
+            else:
+                os.replace(staged_blob, blob_path)
+            dest_video = link_video(job_id, blob_path)
+        update_job(job_id, video_sha=sha)
+        logger.info(f"Video moved from {source_video} to {dest_video} (blob {sha})")
+        return True, dest_video
+    except Exception as e:
+        logger.error(f"Error publishing video for job_id {job_id}: {str(e)}")
+        if staged_blob:
+            with contextlib.suppress(OSError):
+                os.remove(staged_blob)
+        return False, str(e)
+
+
+def tree_size(path: str) -> int:
+    """Bytes used by a file, or by every file under a directory."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def storage_entries(storage_class: dict) -> list:
+    """List a storage class as (last_used, size, path) entries."""
+    entries = []
+    for directory in storage_class["directories"]:
+        for path in Path(directory).glob(storage_class["pattern"]):
+            try:
+                st = path.lstat()
+                last_used = st.st_atime if storage_class["by_access"] else st.st_mtime
+                if storage_class.get("shared") and st.st_nlink > 1:
+                    # One link is the blob itself, the rest are jobs sharing it
+                    size = st.st_size // (st.st_nlink - 1)
+                else:
+                    size = tree_size(str(path))
+                entries.append((last_used, size, str(path)))
+            except FileNotFoundError:
+                continue
+    return entries
+
+
+def remove_orphan_blobs() -> List[str]:
+    """Delete blobs no job links to any more. A blob's link count is its reference count."""
+    removed = []
+    for path in Path(BLOB_DIR).glob("*.mp4"):
+        try:
+            with blob_lock:
+                if path.stat().st_nlink == 1:
+                    path.unlink()
+                    removed.append(str(path))
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def collect_garbage(protected: set) -> Dict[str, dict]:
+    """Apply every storage class's TTL and quota, skipping protected paths.
+    Returns {class: {"paths": [...], "bytes": reclaimed}}."""
+    now = time.time()
+    removed = {}
+    for name, storage_class in STORAGE_CLASSES.items():
+        entries = [
+            entry
+            for entry in storage_entries(storage_class)
+            if os.path.normpath(entry[2]) not in protected
+        ]
+        paths = []
+        reclaimed = 0
+        for _, size, path in select_evictions(
+            entries, storage_class["quota_mb"], storage_class["ttl_hours"], now
+        ):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Storage GC could not remove {path}: {str(e)}")
+                continue
+            paths.append(path)
+            reclaimed += size
+        removed[name] = {"paths": paths, "bytes": reclaimed}
+
+    removed["blobs"] = {"paths": remove_orphan_blobs(), "bytes": 0}
+    return removed
+
+
+async def run_garbage_collection():
+    """Run one GC pass off the event loop, then mark jobs whose video is gone as expired."""
+    protected = {
+        os.path.normpath(job["video_path"])
+        for job in job_store.values()
+        if job.get("video_path") and job.get("status") not in TERMINAL_STATUSES
+    }
+    removed = await asyncio.get_running_loop().run_in_executor(
+        None, collect_garbage, protected
+    )
+
+    for name, result in removed.items():
+        gc_stats["reclaimed_bytes"][name] = (
+            gc_stats["reclaimed_bytes"].get(name, 0) + result["bytes"]
+        )
+        gc_stats["removed"][name] = gc_stats["removed"].get(name, 0) + len(result["paths"])
+        if result["paths"]:
             logger.info(
-                f"Multiple videos found, using the newest one: {video_files[0]}"
+                f"Storage GC removed {len(result['paths'])} {name} entries "
+                f"({result['bytes']} bytes)"
             )
 
-        source_video = str(video_files[0])
-        dest_video = f"videos/{job_id}.mp4"
+    for job_id, job in list(job_store.items()):
+        if (
+            job.get("status") == "completed"
+            and job.get("video_path")
+            and not os.path.exists(job["video_path"])
+        ):
+            update_job(
+                job_id,
+                status="expired",
+                video_path=None,
+                progress_details="Video removed by storage retention",
+            )
+            gc_stats["expired_jobs"] += 1
 
-        shutil.copy2(source_video, dest_video)
-        logger.info(f"Video copied from {source_video} to {dest_video}")
+    gc_stats["runs"] += 1
+    gc_stats["last_run"] = time.time()
 
-        return True, dest_video
-    except Exception as e:
-        logger.error(f"Error finding/moving video for job_id {job_id}: {str(e)}")
-        return False, str(e)
 
+async def garbage_collector():
+    """Background loop running the storage GC every GC_INTERVAL seconds."""
+    while True:
+        try:
+            await run_garbage_collection()
+        except Exception as e:
+            logger.error(f"Storage GC failed: {str(e)}")
+        await asyncio.sleep(GC_INTERVAL)
+
+
+async def prepare_candidate(
+    job_id: str,
+    topic: str,
+    index: int,
+    max_tokens: int,
+    priority: int = PRIORITY_CLASSES["normal"],
+):
+    """Generate one candidate script and validate it with pre-flight and a dry run.
+    Returns (passed, code, error_message)."""
+    model = CANDIDATE_MODELS[index % len(CANDIDATE_MODELS)]
+    temperature = CANDIDATE_TEMPERATURES[index % len(CANDIDATE_TEMPERATURES)]
+    candidate_id = f"{job_id}_{index}"
+    workspace = create_workspace(candidate_id)
+    file_path = os.path.join(workspace, f"manim_code_{candidate_id}.py")
+
+    try:
+        async with generation_scheduler.slot(job_id, priority):
+            code = await generate_manim_code(
+                topic, model=model, temperature=temperature, max_tokens=max_tokens
+            )
+
+        preflight_error = preflight_check(code) or budget_error(estimate_render_cost(code))
+        if preflight_error:
+            return False, code, preflight_error
 
-async def generate_visualization(job_id: str, topic: str):
-    """Background task to generate the visualization with improved status reporting."""
-    file_path = f"manim_code_{job_id}.py"
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(code)
 
+        await precompile_tex(code, job_id)
+        async with render_scheduler.slot(job_id, priority):
+            started = time.monotonic()
+            success, error_message = await run_manim_command(
+                file_path, candidate_id, timeout=DRY_RUN_TIMEOUT, dry_run=True
+            )
+            record_timing(job_id, "candidate_dry_run", time.monotonic() - started)
+
+        if error_message == TIMEOUT_ERROR.format(timeout=DRY_RUN_TIMEOUT):
+            success = True
+        return success, code, error_message
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+async def race_candidates(
+    job_id: str,
+    topic: str,
+    count: int,
+    token_budget: Optional[int] = None,
+    priority: int = PRIORITY_CLASSES["normal"],
+):
+    """Prepare candidate scripts concurrently and keep the first one that validates.
+    The remaining candidates are cancelled. Returns (passed, code, error_message), where
+    a failed race reports the last candidate's code and error."""
+    max_tokens = MAX_TOKENS
+    if token_budget is not None:
+        count = max(1, min(count, token_budget // MIN_CANDIDATE_TOKENS))
+        max_tokens = max(1, min(MAX_TOKENS, token_budget // count))
+
+    logger.info(f"Racing {count} candidates for job {job_id} ({max_tokens} tokens each)")
+    tasks = [
+        asyncio.create_task(
+            prepare_candidate(job_id, topic, index, max_tokens, priority)
+        )
+        for index in range(count)
+    ]
+
+    last_code = None
+    last_error = None
     try:
-        job_store[job_id]["status"] = "generating_code"
-        job_store[job_id]["progress_details"] = "Requesting code from Claude"
+        for finished in asyncio.as_completed(tasks):
+            try:
+                passed, code, error_message = await finished
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                last_error = str(e)
+                continue
+
+            if passed:
+                return True, code, None
+            last_code, last_error = code, error_message
+
+        return False, last_code, last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def cache_serves(entry: dict, tiers) -> bool:
+    """Whether a cached render can be served to a request for tiers. A preview is only
+    good enough when the request accepts one; it is then upgraded like a fresh one.
+    Entries from before quality was recorded were rendered at preview quality."""
+    return "preview" in tiers or entry.get("quality", "preview") == "final"
+
+
+def cached_video_valid(entry: dict) -> bool:
+    """Whether a cache entry's video still exists and is the blob named by its hash.
+    Entries point at the immutable blob, never at a job link an upgrade may replace."""
+    video_sha = entry.get("video_sha")
+    return (
+        bool(video_sha)
+        and entry["video_path"] == os.path.join(BLOB_DIR, f"{video_sha}.mp4")
+        and os.path.exists(entry["video_path"])
+    )
+
+
+def cache_render(job_id: str, code_key: str, topic_key: str, video_path: str, quality: str):
+    """Remember a published render, and the quality it was made at, by code and topic.
+    The entries store the job's blob rather than video_path, whose bytes change when a
+    preview is upgraded."""
+    video_sha = job_store.get(job_id, {}).get("video_sha")
+    if video_sha:
+        video_path = os.path.join(BLOB_DIR, f"{video_sha}.mp4")
+    code_cache.put(
+        code_key,
+        {
+            "status": "completed",
+            "video_path": video_path,
+            "video_sha": video_sha,
+            "quality": quality,
+        },
+    )
+    topic_cache.put(
+        topic_key,
+        {
+            "job_id": job_id,
+            "video_path": video_path,
+            "video_sha": video_sha,
+            "quality": quality,
+            "created_at": time.time(),
+        },
+    )
+
+
+async def upgrade_video(job_id: str, code: str, topic_key: str):
+    """Re-render a previewed job at FINAL_QUALITY in the low-priority queue, then swap
+    the served video for it with one atomic rename. The preview is kept on failure."""
+    media_id = f"{job_id}_final"
+    estimate = estimate_render_cost(code, FINAL_QUALITY)
+    workspace = create_workspace(media_id)
+    file_path = os.path.join(workspace, f"manim_code_{job_id}.py")
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(code)
+        update_job(job_id, progress_details="Rendering the high quality version")
+        render_seconds = []
+        success, error_message, source_video = await render_scenes(
+            file_path,
+            job_id,
+            code,
+            PRIORITY_CLASSES["low"],
+            quality=FINAL_QUALITY,
+            media_id=media_id,
+            timeout=render_timeout(estimate, ceiling=FINAL_RENDER_TIMEOUT),
+            stage="render_final",
+            render_seconds=render_seconds,
+        )
+        if success:
+            log_render_cost(job_id, estimate, "render_final", render_seconds)
+            success, error_message = await publish_video(job_id, source_video)
+
+        if success:
+            logger.info(f"Swapped in the high quality video for job {job_id}")
+            cache_render(job_id, code_hash(code), topic_key, error_message, "final")
+            update_job(
+                job_id,
+                status="completed",
+                quality="final",
+                progress_details="High quality version ready",
+            )
+        else:
+            logger.warning(f"High quality render failed for job {job_id}: {error_message}")
+            update_job(
+                job_id,
+                status="completed",
+                progress_details="High quality render failed, keeping the preview",
+                final_error=error_message or "High quality render produced no video",
+            )
+    except Exception as e:
+        logger.error(f"Error upgrading video for job {job_id}: {str(e)}")
+        update_job(
+            job_id,
+            status="completed",
+            progress_details="High quality render failed, keeping the preview",
+            final_error=str(e),
+        )
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+async def generate_visualization(
+    job_id: str,
+    topic: str,
+    candidates: int = 1,
+    token_budget: Optional[int] = None,
+    session_id: Optional[str] = None,
+    priority: int = PRIORITY_CLASSES["normal"],
+    tiers: List[str] = ("preview",),
+):
+    """Background task to generate the visualization with improved status reporting.
+    Code generation and rendering each wait for a slot in their stage's scheduler.
+    With both "preview" and "final" tiers, the job reports preview_ready after a fast
+    render and upgrades to the final quality in the background."""
+    quality = PREVIEW_QUALITY if "preview" in tiers else FINAL_QUALITY
+    topic_key = normalize_topic(topic)
+
+    try:
+        update_job(
+            job_id,
+            status="generating_code",
+            progress_details="Requesting code from Claude",
+        )
 
         retry_count = 0
         last_error = None
+        last_code = None
         success = False
 
         while retry_count <= MAX_RETRIES and not success:
+            workspace = create_workspace(f"{job_id}_attempt{retry_count}")
+            file_path = os.path.join(workspace, f"manim_code_{job_id}.py")
             try:
                 if retry_count > 0:
-                    job_store[job_id][
-                        "status"
-                    ] = f"retry_{retry_count}_of_{MAX_RETRIES}"
-                    job_store[job_id][
-                        "progress_details"
-                    ] = f"Attempting code generation (attempt {retry_count+1})"
+                    update_job(
+                        job_id,
+                        status=f"retry_{retry_count}_of_{MAX_RETRIES}",
+                        progress_details=f"Attempting code generation (attempt {retry_count+1})",
+                    )
 
-                code = await generate_manim_code(topic, last_error, retry_count)
+                update_job(job_id, attempts=retry_count + 1)
+                previous_code, last_code = last_code, None
+
+                validated = False
+                if retry_count == 0 and candidates > 1:
+                    update_job(
+                        job_id,
+                        status="racing_candidates",
+                        progress_details=f"Generating and validating {candidates} candidate scripts",
+                    )
+                    validated, code, race_error = await race_candidates(
+                        job_id, topic, candidates, token_budget, priority
+                    )
+                    if not validated:
+                        last_code = code
+                        raise Exception(race_error)
+                else:
+                    async with generation_scheduler.slot(job_id, priority):
+                        code = await generate_manim_code(
+                            topic,
+                            last_error,
+                            retry_count,
+                            job_id=job_id,
+                            previous_code=previous_code,
+                            session_id=session_id,
+                        )
+                last_code = code
 
                 with open(file_path, "w", encoding="utf-8") as f:
                     f.write(code)
 
-                job_store[job_id]["status"] = "rendering_video"
-                job_store[job_id][
-                    "progress_details"
-                ] = "Executing Manim to render visualization"
-
-                success, error_message = await run_manim_command(
-                    file_path, job_id, timeout=300
+                update_job(
+                    job_id,
+                    status="validating_code",
+                    progress_details="Checking generated code before rendering",
+                )
+                preflight_error = None if validated else preflight_check(code)
+                estimate = estimate_render_cost(code, quality)
+                render_timeout_seconds = render_timeout(
+                    estimate,
+                    ceiling=MAX_RENDER_TIMEOUT
+                    if quality == PREVIEW_QUALITY
+                    else FINAL_RENDER_TIMEOUT,
+                )
+                update_job(
+                    job_id,
+                    estimate=estimate,
+                    estimated_cost=estimate["cpu_seconds"] if estimate else None,
                 )
+                # The budget is set for the preview render, whichever quality runs first
+                if quality != PREVIEW_QUALITY:
+                    preflight_error = preflight_error or budget_error(estimate_render_cost(code))
+                else:
+                    preflight_error = preflight_error or budget_error(estimate)
+
+                code_key = code_hash(code)
+                cached_render = None
+                if not preflight_error:
+                    cached_render = code_cache.get(
+                        code_key,
+                        is_valid=lambda entry: entry["status"] == "failed"
+                        or cached_video_valid(entry),
+                    )
+                    if (
+                        cached_render
+                        and cached_render["status"] == "completed"
+                        and not cache_serves(cached_render, tiers)
+                    ):
+                        logger.info(f"Cached render for job {job_id} is only a preview")
+                        cached_render = None
+
+                if preflight_error:
+                    logger.info(f"Pre-flight check rejected code for job {job_id}")
+                    success, error_message = False, preflight_error
+                elif cached_render and cached_render["status"] == "failed":
+                    logger.info(f"Code cache hit on known-bad code for job {job_id}")
+                    success, error_message = False, cached_render["error"]
+                elif cached_render:
+                    logger.info(f"Code cache hit for job {job_id}")
+                    success, error_message = True, None
+                else:
+                    success, error_message = True, None
+                    update_job(job_id, progress_details="Pre-compiling LaTeX expressions")
+                    await precompile_tex(code, job_id)
+                    if not validated:
+                        update_job(
+                            job_id,
+                            status="validating",
+                            progress_details="Dry-running the scene before the full render",
+                        )
+                        async with render_scheduler.slot(job_id, priority):
+                            started = time.monotonic()
+                            success, error_message = await run_manim_command(
+                                file_path, job_id, timeout=DRY_RUN_TIMEOUT, dry_run=True
+                            )
+                            record_timing(job_id, "dry_run", time.monotonic() - started)
+
+                    if error_message == TIMEOUT_ERROR.format(timeout=DRY_RUN_TIMEOUT):
+                        logger.info(
+                            f"Dry run inconclusive for job {job_id}, rendering anyway"
+                        )
+                        success = True
+
+                    if success:
+                        update_job(
+                            job_id,
+                            status="rendering_video",
+                            progress_details="Executing Manim to render visualization",
+                        )
+
+                        render_seconds = []
+                        success, error_message, rendered_video = await render_scenes(
+                            file_path,
+                            job_id,
+                            code,
+                            priority,
+                            quality,
+                            timeout=render_timeout_seconds,
+                            render_seconds=render_seconds,
+                        )
+                        if success:
+                            log_render_cost(job_id, estimate, "render", render_seconds)
+                    else:
+                        stage_stats.setdefault("dry_run_rejections", {"count": 0})
+                        stage_stats["dry_run_rejections"]["count"] += 1
+
+                    if not success and isinstance(error_message, ManimFailure):
+                        code_cache.put(
+                            code_key, {"status": "failed", "error": error_message}
+                        )
 
                 if not success:
                     retry_count += 1
                     last_error = error_message
-                    job_store[job_id]["error"] = f"Rendering failed: {error_message}"
-                    job_store[job_id][
-                        "progress_details"
-                    ] = f"Rendering failed on attempt {retry_count}"
+                    update_job(
+                        job_id,
+                        error=f"Rendering failed: {error_message}",
+                        progress_details=f"Rendering failed on attempt {retry_count}",
+                    )
                     logger.warning(
                         f"Manim rendering failed on attempt {retry_count}. Error: {error_message}"
                     )
 
                     if retry_count >= MAX_RETRIES:
-                        job_store[job_id]["status"] = "failed"
+                        update_job(job_id, status="failed")
                         break
                     else:
                         await asyncio.sleep(2)
                         continue
 
-                job_store[job_id]["status"] = "processing_video"
-                job_store[job_id]["progress_details"] = "Finding and moving video file"
+                update_job(
+                    job_id,
+                    status="processing_video",
+                    progress_details="Finding and moving video file",
+                )
 
-                video_success, video_result = await find_and_move_video(job_id)
+                if cached_render:
+                    video_success, video_result = True, link_video(
+                        job_id, cached_render["video_path"]
+                    )
+                    update_job(job_id, video_sha=cached_render.get("video_sha"))
+                else:
+                    video_success, video_result = await publish_video(job_id, rendered_video)
 
                 if not video_success:
                     retry_count += 1
                     last_error = video_result
-                    job_store[job_id][
-                        "error"
-                    ] = f"Video processing failed: {video_result}"
-                    job_store[job_id][
-                        "progress_details"
-                    ] = f"Video processing failed on attempt {retry_count}"
+                    update_job(
+                        job_id,
+                        error=f"Video processing failed: {video_result}",
+                        progress_details=f"Video processing failed on attempt {retry_count}",
+                    )
                     logger.warning(
                         f"Video file handling failed on attempt {retry_count}. Error: {video_result}"
                     )
 
                     if retry_count >= MAX_RETRIES:
-                        job_store[job_id]["status"] = "failed"
+                        update_job(job_id, status="failed")
                         break
                     else:
                         await asyncio.sleep(2)
                         continue
 
-                job_store[job_id]["status"] = "completed"
-                job_store[job_id]["video_path"] = video_result
-                job_store[job_id][
-                    "progress_details"
-                ] = "Visualization successfully completed"
-                job_store[job_id]["error"] = None
+                if cached_render:
+                    served_quality = cached_render.get("quality", "preview")
+                else:
+                    served_quality = "preview" if quality == PREVIEW_QUALITY else "final"
+                cache_render(job_id, code_key, topic_key, video_result, served_quality)
+
+                attempt_stats["completed_jobs"] += 1
+                attempt_stats["attempts"] += retry_count + 1
+
+                if "final" in tiers and served_quality != "final":
+                    update_job(
+                        job_id,
+                        status="preview_ready",
+                        quality="preview",
+                        video_path=video_result,
+                        progress_details="Preview ready, high quality version queued",
+                        error=None,
+                    )
+                    task = asyncio.create_task(
+                        upgrade_video(job_id, code, topic_key)
+                    )
+                    background_renders.add(task)
+                    task.add_done_callback(background_renders.discard)
+                else:
+                    update_job(
+                        job_id,
+                        status="completed",
+                        quality=served_quality,
+                        video_path=video_result,
+                        progress_details="Visualization successfully completed",
+                        error=None,
+                    )
                 success = True
 
+            except CircuitOpenError as e:
+                last_error = str(e)
+                update_job(
+                    job_id,
+                    status="failed",
+                    error=last_error,
+                    progress_details="Anthropic API unavailable",
+                )
+                break
+
             except Exception as e:
                 retry_count += 1
                 last_error = str(e)
-                job_store[job_id]["error"] = f"Error: {last_error}"
-                job_store[job_id][
-                    "progress_details"
-                ] = f"Error on attempt {retry_count}: {last_error}"
+                update_job(
+                    job_id,
+                    error=f"Error: {last_error}",
+                    progress_details=f"Error on attempt {retry_count}: {last_error}",
+                )
                 logger.error(
                     f"Error in visualization attempt {retry_count}: {last_error}"
                 )
@@ -380,31 +3036,39 @@ async def generate_visualization(job_id: str, topic: str):
                 if retry_count < MAX_RETRIES:
                     await asyncio.sleep(2)
                 else:
-                    job_store[job_id]["status"] = "failed"
-                    job_store[job_id][
-                        "progress_details"
-                    ] = f"Failed after {MAX_RETRIES} attempts"
+                    update_job(
+                        job_id,
+                        status="failed",
+                        progress_details=f"Failed after {MAX_RETRIES} attempts",
+                    )
+
+            finally:
+                shutil.rmtree(workspace, ignore_errors=True)
 
-        # Keep the generated Manim code file for debugging
-        # if os.path.exists(file_path):
-        #     os.remove(file_path)
+        # Keep the generated Manim code for debugging
+        if last_code:
+            update_job(job_id, code_path=save_code_artifact(job_id, last_code))
 
         if not success and job_store[job_id]["status"] != "failed":
-            job_store[job_id]["status"] = "failed"
-            job_store[job_id][
-                "progress_details"
-            ] = f"Failed after {MAX_RETRIES} attempts"
-            job_store[job_id]["error"] = f"Last error: {last_error}"
+            update_job(
+                job_id,
+                status="failed",
+                progress_details=f"Failed after {MAX_RETRIES} attempts",
+                error=f"Last error: {last_error}",
+            )
 
     except Exception as e:
         logger.error(f"Fatal error in generate_visualization: {str(e)}")
-        job_store[job_id]["status"] = "failed"
-        job_store[job_id]["error"] = str(e)
-        job_store[job_id]["progress_details"] = "Unexpected error in generation process"
+        update_job(
+            job_id,
+            status="failed",
+            error=str(e),
+            progress_details="Unexpected error in generation process",
+        )
 
-        # Keep the generated Manim code file for debugging
-        # if os.path.exists(file_path):
-        #     os.remove(file_path)
+    finally:
+        if inflight_jobs.get(topic_key) == job_id:
+            del inflight_jobs[topic_key]
 
 
 async def stream_video(video_path: str):
@@ -460,16 +3124,94 @@ async def generate_endpoint(
 ):
     """Endpoint to request a math visualization."""
     job_id = str(uuid.uuid4())
+    topic_key = normalize_topic(request.topic)
+
+    tiers = request.tiers or ["preview"]
+    cached = None
+    if not request.force_render:
+        cached = topic_cache.get(
+            topic_key,
+            is_valid=cached_video_valid,
+        )
+    if cached and "final" in tiers and cached.get("quality", "preview") != "final":
+        # A topic hit has no code to upgrade from; render it so the final tier follows
+        logger.info(f"Render cache for topic {request.topic} only holds a preview")
+        cached = None
+
+    video_path = None
+    if cached:
+        try:
+            video_path = link_video(job_id, cached["video_path"])
+        except OSError:
+            cached = None
+
+    if cached:
+        logger.info(f"Render cache hit for topic: {request.topic}")
+        job_store[job_id] = {
+            "status": "completed",
+            "topic": request.topic,
+            "created_at": time.time(),
+            "error": None,
+            "video_path": video_path,
+            "video_sha": cached.get("video_sha"),
+            "quality": cached.get("quality", "preview"),
+            "cached_from": cached["job_id"],
+            "progress_details": "Served from render cache",
+        }
+        return JSONResponse(
+            {
+                "job_id": job_id,
+                "status": "completed",
+                "video_path": video_path,
+                "error": "",
+                "message": "Visualization served from the render cache. Set force_render to render it again.",
+            }
+        )
+
+    leader_id = inflight_jobs.get(topic_key)
+    if not request.force_render and leader_id in job_store:
+        leader = job_store[leader_id]
+        logger.info(f"Attaching job {job_id} to in-flight job {leader_id}")
+        job_store[job_id] = {
+            "status": leader["status"],
+            "topic": request.topic,
+            "created_at": time.time(),
+            "error": leader.get("error"),
+            "video_path": leader.get("video_path"),
+            "progress_details": leader.get("progress_details"),
+            "alias_of": leader_id,
+        }
+        leader.setdefault("followers", []).append(job_id)
+        return JSONResponse(
+            {
+                "job_id": job_id,
+                "status": leader["status"],
+                "video_path": "",
+                "error": "",
+                "message": "An identical visualization is already being generated. This job will complete with it.",
+            }
+        )
 
     job_store[job_id] = {
         "status": "queued",
         "topic": request.topic,
+        "priority": request.priority,
         "created_at": time.time(),
         "error": None,
         "video_path": None,
     }
-
-    background_tasks.add_task(generate_visualization, job_id, request.topic)
+    inflight_jobs[topic_key] = job_id
+
+    background_tasks.add_task(
+        generate_visualization,
+        job_id,
+        request.topic,
+        candidates=max(1, min(request.candidates, MAX_CANDIDATES)),
+        token_budget=request.max_candidate_tokens,
+        session_id=request.session_id,
+        priority=PRIORITY_CLASSES[request.priority],
+        tiers=tiers,
+    )
 
     return JSONResponse(
         {
@@ -498,13 +3240,43 @@ async def root():
                 "method": "GET",
                 "description": "Check status of a job",
             },
+            {
+                "path": "/events/{job_id}",
+                "method": "GET",
+                "description": "Server-sent events with job progress",
+            },
             {"path": "/list-jobs", "method": "GET", "description": "List all jobs"},
+            {
+                "path": "/jobs",
+                "method": "GET",
+                "description": "Bulk, filtered and paginated job status",
+            },
             {
                 "path": "/video/{job_id}",
                 "method": "GET",
                 "description": "Stream video file",
             },
             {"path": "/chat", "method": "POST", "description": "Chat about Manim code"},
+            {
+                "path": "/cache-stats",
+                "method": "GET",
+                "description": "Render cache hit/miss counters",
+            },
+            {
+                "path": "/render-stats",
+                "method": "GET",
+                "description": "Pipeline stage timings",
+            },
+            {
+                "path": "/storage-stats",
+                "method": "GET",
+                "description": "Disk usage and storage GC counters",
+            },
+            {
+                "path": "/llm-stats",
+                "method": "GET",
+                "description": "Anthropic client queue and latency stats",
+            },
         ],
         "usage": "Send a POST request to /generate with a JSON body containing 'topic'",
     }
@@ -514,7 +3286,7 @@ async def root():
 async def status_endpoint(job_id: str):
     """Check the status of a visualization job."""
     try:
-        logger.info(f"Status check requested for job: {job_id}")
+        logger.debug(f"Status check requested for job: {job_id}")
 
         if job_id not in job_store:
             logger.warning(f"Job not found: {job_id}")
@@ -527,13 +3299,15 @@ async def status_endpoint(job_id: str):
             }
 
         job = job_store[job_id]
-        logger.info(f"Job data: {job}")
+        logger.debug(f"Job data: {job}")
 
         return {
             "job_id": job_id,
             "status": job["status"],
             "video_path": job.get("video_path") or "",  
             "error": job.get("error") or "",  
+            "queue_position": job.get("queue_position"),
+            "quality": job.get("quality"),
         }
     except Exception as e:
         logger.error(f"Error in status endpoint: {str(e)}")
@@ -546,41 +3320,320 @@ async def status_endpoint(job_id: str):
         }
 
 
+@app.get("/events/{job_id}")
+async def job_events(job_id: str):
+    """Server-sent events stream of a job's status and progress until it finishes."""
+    if job_id not in job_store:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    queue = asyncio.Queue(maxsize=16)
+    job_listeners.setdefault(job_id, []).append(queue)
+
+    async def generate():
+        try:
+            snapshot = job_snapshot(job_id)
+            yield f"data: {json.dumps(snapshot)}\n\n"
+
+            while snapshot["status"] not in TERMINAL_STATUSES:
+                try:
+                    snapshot = await asyncio.wait_for(
+                        queue.get(), timeout=EVENT_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(snapshot)}\n\n"
+        finally:
+            listeners = job_listeners.get(job_id, [])
+            if queue in listeners:
+                listeners.remove(queue)
+            if not listeners:
+                job_listeners.pop(job_id, None)
+                last_job_events.pop(job_id, None)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def conditional_json(request: Request, payload: dict):
+    """Return payload with a content-hash ETag, or an empty 304 if the client
+    already has this exact payload."""
+    body = json.dumps(payload, sort_keys=True)
+    etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return Response(
+        content=body, media_type="application/json", headers={"ETag": etag}
+    )
+
+
 @app.get("/list-jobs")
-async def list_jobs():
+async def list_jobs(request: Request):
     """List all jobs and their statuses."""
-    return {
-        "jobs": [
+    return conditional_json(
+        request,
+        {
+            "jobs": [
+                {
+                    "job_id": job_id,
+                    "status": details["status"],
+                    "topic": details["topic"],
+                    "created_at": details["created_at"],
+                }
+                for job_id, details in job_store.items()
+            ]
+        },
+    )
+
+
+@app.get("/jobs")
+async def jobs_endpoint(
+    request: Request,
+    ids: Optional[str] = None,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+):
+    """Status, video availability and error for many jobs in one response.
+    ids is a comma-separated list of job IDs and status a comma-separated list of
+    statuses. Jobs are returned newest first, and next_cursor fetches the next page."""
+    limit = max(1, min(limit, JOBS_PAGE_LIMIT))
+
+    if ids:
+        job_ids = [job_id for job_id in ids.split(",") if job_id in job_store]
+    else:
+        job_ids = list(job_store)
+
+    if status:
+        statuses = set(status.split(","))
+        job_ids = [
+            job_id for job_id in job_ids if job_store[job_id]["status"] in statuses
+        ]
+
+    keys = sorted(
+        ((job_store[job_id]["created_at"], job_id) for job_id in job_ids),
+        reverse=True,
+    )
+
+    if cursor:
+        try:
+            created_at, _, cursor_id = cursor.partition(":")
+            after = (float(created_at), cursor_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        keys = [key for key in keys if key < after]
+
+    page = keys[:limit]
+    jobs = []
+    for created_at, job_id in page:
+        job = job_store[job_id]
+        video_path = job.get("video_path")
+        jobs.append(
             {
                 "job_id": job_id,
-                "status": details["status"],
-                "topic": details["topic"],
-                "created_at": details["created_at"],
+                "topic": job["topic"],
+                "status": job["status"],
+                "created_at": created_at,
+                "video_available": bool(video_path) and os.path.exists(video_path),
+                "error": job.get("error") or "",
             }
-            for job_id, details in job_store.items()
-        ]
+        )
+
+    next_cursor = None
+    if len(keys) > limit:
+        next_cursor = f"{page[-1][0]!r}:{page[-1][1]}"
+
+    return conditional_json(request, {"jobs": jobs, "next_cursor": next_cursor})
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    """Report render cache hit/miss counters."""
+    return {"topic_cache": topic_cache.stats(), "code_cache": code_cache.stats()}
+
+
+@app.get("/storage-stats")
+async def storage_stats():
+    """Report disk usage per artifact class and what the storage GC has reclaimed."""
+    entries = await asyncio.get_running_loop().run_in_executor(
+        None,
+        lambda: {name: storage_entries(c) for name, c in STORAGE_CLASSES.items()},
+    )
+    return {
+        "classes": {
+            name: {
+                "entries": len(entries[name]),
+                "bytes": sum(size for _, size, _ in entries[name]),
+                "quota_mb": storage_class["quota_mb"],
+                "ttl_hours": storage_class["ttl_hours"],
+            }
+            for name, storage_class in STORAGE_CLASSES.items()
+        },
+        "gc": gc_stats,
+    }
+
+
+@app.get("/render-stats")
+async def render_stats():
+    """Report average stage timings and the render time saved by dry runs."""
+    stages = {
+        stage: {
+            "count": stats["count"],
+            "average_seconds": stats["total_seconds"] / stats["count"],
+        }
+        for stage, stats in stage_stats.items()
+        if "total_seconds" in stats and stats["count"]
+    }
+    rejections = stage_stats.get("dry_run_rejections", {}).get("count", 0)
+    average_render = stages.get("render", {}).get("average_seconds", 0.0)
+    return {
+        "stages": stages,
+        "dry_run_rejections": rejections,
+        "estimated_render_seconds_saved": rejections * average_render,
+        "completed_jobs": attempt_stats["completed_jobs"],
+        "average_attempts_per_completed_job": (
+            attempt_stats["attempts"] / attempt_stats["completed_jobs"]
+            if attempt_stats["completed_jobs"]
+            else 0.0
+        ),
+        "schedulers": {
+            "generation": generation_scheduler.stats(),
+            "render": render_scheduler.stats(),
+        },
+        "faststart": {
+            "checked": faststart_stats["checked"],
+            "remuxed": faststart_stats["remuxed"],
+            "average_moov_offset_before": (
+                faststart_stats["moov_offset_before"] / faststart_stats["checked"]
+                if faststart_stats["checked"]
+                else 0.0
+            ),
+            "average_moov_offset_after": (
+                faststart_stats["moov_offset_after"] / faststart_stats["checked"]
+                if faststart_stats["checked"]
+                else 0.0
+            ),
+        },
+        "cost_estimator": {
+            "samples": estimate_stats["samples"],
+            "average_actual_to_predicted": (
+                estimate_stats["actual_to_predicted"] / estimate_stats["samples"]
+                if estimate_stats["samples"]
+                else 0.0
+            ),
+        },
     }
 
 
+@app.get("/llm-stats")
+async def llm_stats():
+    """Report Anthropic client queue depth, retries, circuit state and latency."""
+    return __anthropic.stats()
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that awaits on_close however the response ends, including a
+    client that disconnects before the body is iterated and its generator never runs."""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
 @app.post("/chat")
 async def chat(chat: ChatMessage):
-    append_chat(role="user", message=chat.message)
-    message = await __anthropic.messages.create(
+    """Stream the assistant's reply as plain text chunks.
+    The session used is returned in the X-Session-Id header."""
+    session_id = chat.session_id or str(uuid.uuid4())
+    append_chat(session_id, role="user", message=chat.message)
+    messages = list(chat_history(session_id))
+
+    # Open the stream before responding, so an open circuit is a 503 rather than a
+    # 200 whose body is an error message
+    stream_context = __anthropic.stream(
         model="claude-3-5-haiku-latest",
         max_tokens=MAX_TOKENS,
         temperature=0.1,
         system="You are an expert at mathematics. Your job is to assist the user in their queries. Attention: Do not answer any other questions other than math related or coding related questions.",
-        messages=chat_context,
+        messages=messages,
+    )
+    try:
+        stream = await stream_context.__aenter__()
+    except CircuitOpenError as e:
+        chat_history(session_id).pop()
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error opening chat stream: {str(e)}")
+        chat_history(session_id).pop()
+        raise HTTPException(status_code=502, detail=str(e))
+
+    parts = []
+    closed = False
+
+    async def close(error: Optional[Exception] = None):
+        # Runs from the body's finally and again once the response ends; the first wins
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        try:
+            await stream_context.__aexit__(
+                type(error) if error else None,
+                error,
+                error.__traceback__ if error else None,
+            )
+        finally:
+            history = chat_history(session_id)
+            if parts:
+                append_chat(session_id, role="assistant", message="".join(parts))
+            elif history and history[-1]["role"] == "user":
+                history.pop()
+
+    async def generate():
+        error = None
+        try:
+            async for text in stream.text_stream:
+                parts.append(text)
+                yield text
+        except Exception as e:
+            error = e
+            logger.error(f"Error in chat stream: {str(e)}")
+            yield f"\n\n[Error: {str(e)}]"
+        finally:
+            await close(error)
+
+    return ClosingStreamingResponse(
+        generate(),
+        close,
+        media_type="text/plain; charset=utf-8",
+        headers={"X-Session-Id": session_id},
     )
 
-    response = message.content[0].text
-    append_chat(role="assistant", message=response)
-    return {"response": response}
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag, as RFC 9110 asks."""
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
 
 
 @app.get("/video/{job_id}")
-async def get_video(job_id: str):
-    """Stream a video for a completed job using ffmpeg."""
+async def get_video(job_id: str, request: Request):
+    """Serve a job's video. Range and If-Range requests get 206 partial content, and an
+    If-None-Match that matches the content hash gets 304."""
     if job_id not in job_store:
         raise HTTPException(status_code=404, detail="Job not found")
 
@@ -592,6 +3645,33 @@ async def get_video(job_id: str):
     if not os.path.exists(video_path):
         raise HTTPException(status_code=404, detail="Video file not found")
 
+    # The access time is the last-served time the storage GC evicts by
+    try:
+        os.utime(video_path, (time.time(), os.stat(video_path).st_mtime))
+    except OSError:
+        pass
+
+    video_sha = job.get("video_sha")
+    if not video_sha:
+        video_sha = await asyncio.get_running_loop().run_in_executor(
+            None, file_sha256, video_path
+        )
+        update_job(job_id, video_sha=video_sha)
+
+    etag = f'"{video_sha}"'
+    # A previewed job's video is replaced by the final render, so it must be
+    # revalidated; a completed job's content never changes.
+    cache_control = (
+        "public, max-age=31536000, immutable"
+        if job["status"] == "completed"
+        else "no-cache"
+    )
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(
+            status_code=304, headers={"ETag": etag, "Cache-Control": cache_control}
+        )
+
     # Check if ffmpeg is available
     # try:
     #     subprocess.run(["ffmpeg", "-version"], check=True, capture_output=True)
@@ -610,6 +3690,8 @@ async def get_video(job_id: str):
         headers={
             "Accept-Ranges": "bytes",
             "Content-Disposition": f"inline; filename={job_id}.mp4",
+            "ETag": etag,
+            "Cache-Control": cache_control,
         },
     )
 
@@ -702,6 +3784,13 @@ async def get_job_logs(job_id: str):
             "created_at": job["created_at"],
             "error": job.get("error") or "",
             "video_path": job.get("video_path") or "",
+            "attempts": job.get("attempts", 0),
+            "corrections": job.get("corrections", {}),
+            "timings": job.get("timings", {}),
+            "estimate": job.get("estimate"),
+            "final_error": job.get("final_error") or "",
+            "scene_timings": job.get("scene_timings", {}),
+            "moov_offset": job.get("moov_offset", {}),
         }
 
         return logs
@@ -717,6 +3806,44 @@ async def get_job_logs(job_id: str):
         }
 
 
+@app.on_event("startup")
+async def warm_preflight():
+    """Import manim's exports once up front so pre-flight checks stay fast."""
+    await asyncio.get_running_loop().run_in_executor(None, module_exports, "manim")
+
+
+@app.on_event("startup")
+async def clear_scratch():
+    """Remove attempt workspaces left behind by a server that did not shut down cleanly."""
+    for root in (os.path.join(SCRATCH_DIR, "manimation"), DISK_SCRATCH_DIR):
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@app.on_event("startup")
+async def start_garbage_collector():
+    """Start the background storage GC."""
+    global gc_task
+    gc_task = asyncio.create_task(garbage_collector())
+
+
+@app.on_event("startup")
+async def start_fork_server():
+    """Start the pre-warmed Manim worker so renders skip interpreter and import start-up."""
+    if not FORK_SERVER or sys.platform == "win32":
+        return
+    try:
+        await fork_server.start()
+    except Exception as e:
+        logger.warning(f"Manim fork server unavailable, renders will use subprocesses: {e}")
+
+
+@app.on_event("shutdown")
+async def stop_render_workers():
+    """Stop the Manim fork server and the LaTeX pre-compilation workers."""
+    await fork_server.stop()
+    tex_executor.shutdown(wait=False, cancel_futures=True)
+
+
 if __name__ == "__main__":
     os.makedirs("videos", exist_ok=True)
     uvicorn.run("main:app", reload=False)
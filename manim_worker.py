@@ -0,0 +1,115 @@
+"""Pre-warmed Manim fork server.
+
+Imports manim once, then forks a fresh child for every render request so each job
+skips interpreter start-up and the manim/numpy/cairo imports. Requests and replies
+are JSON lines on stdin/stdout:
+
+    -> {"id": 1, "args": ["-ql", "scene.py"], "cwd": "...", "stdout": "...", "stderr": "..."}
+    <- {"id": 1, "pid": 1234}
+    <- {"id": 1, "returncode": 0}
+    -> {"kill": 1}
+"""
+
+import json
+import os
+import random
+import select
+import signal
+import sys
+import traceback
+
+import numpy
+from manim.__main__ import main as manim_main
+
+
+def reply(message: dict):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def run_child(request: dict):
+    """Runs in the forked child: detach from the control pipes and render."""
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    stdout = os.open(request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    stderr = os.open(request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(devnull, 0)
+    os.dup2(stdout, 1)
+    os.dup2(stderr, 2)
+
+    # Forked children would otherwise share the server's random state.
+    random.seed()
+    numpy.random.seed()
+
+    code = 1
+    try:
+        os.chdir(request["cwd"])
+        sys.argv = ["manim"] + request["args"]
+        manim_main(args=request["args"], prog_name="manim")
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve():
+    running = {}
+    buffer = b""
+    reply({"ready": True})
+
+    while True:
+        readable, _, _ = select.select([0], [], [], 0.1)
+        if readable:
+            chunk = os.read(0, 65536)
+            if not chunk:
+                break
+            buffer += chunk
+
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+
+                if "kill" in request:
+                    for pid, request_id in running.items():
+                        if request_id == request["kill"]:
+                            try:
+                                os.killpg(pid, signal.SIGKILL)
+                            except ProcessLookupError:
+                                pass
+                    continue
+
+                pid = os.fork()
+                if pid == 0:
+                    run_child(request)
+                running[pid] = request["id"]
+                reply({"id": request["id"], "pid": pid})
+
+        while running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            request_id = running.pop(pid, None)
+            if request_id is not None:
+                reply({"id": request_id, "returncode": os.waitstatus_to_exitcode(status)})
+
+    for pid in running:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+if __name__ == "__main__":
+    serve()
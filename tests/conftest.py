@@ -0,0 +1,17 @@
+"""main.py reads config.ini and writes its caches relative to the working directory,
+so the tests import it from a scratch directory with a minimal configuration."""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+WORKDIR = tempfile.mkdtemp(prefix="manimation-tests-")
+with open(os.path.join(WORKDIR, "config.ini"), "w", encoding="utf-8") as f:
+    f.write("[ANTHROPIC]\nAPI_TOKEN=test\n")
+os.chdir(WORKDIR)
@@ -0,0 +1,110 @@
+"""Local stand-in for the Anthropic Messages API, served over real HTTP so a client can
+be pointed at it through base_url. Queue one response per expected request."""
+
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def message(text: str, output_tokens: int = 10) -> dict:
+    return {
+        "id": "msg_fake",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-fake",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": output_tokens},
+    }
+
+
+def stream_events(chunks, finish: bool = True) -> list:
+    """Server-sent events for a streamed reply made of text chunks. Without finish the
+    stream ends before message_delta, like a connection the client closed early."""
+    start = message("", output_tokens=1)
+    start["stop_reason"] = None
+    events = [
+        ("message_start", {"type": "message_start", "message": start}),
+        (
+            "content_block_start",
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+        ),
+    ]
+    for chunk in chunks:
+        events.append(
+            (
+                "content_block_delta",
+                {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}},
+            )
+        )
+    if finish:
+        events += [
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            (
+                "message_delta",
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": len(chunks)},
+                },
+            ),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+    return events
+
+
+class FakeAnthropic:
+    def __init__(self):
+        self.responses = deque()
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                fake.requests.append(json.loads(body or b"{}"))
+                status, payload, headers = fake.responses.popleft()
+
+                if isinstance(payload, list):
+                    self.send_response(status)
+                    self.send_header("content-type", "text/event-stream")
+                    self.end_headers()
+                    for event, data in payload:
+                        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                    return
+
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def respond(self, payload, status: int = 200, headers: dict = None):
+        self.responses.append((status, payload, headers or {}))
+
+    def error(self, status: int, error_type: str, headers: dict = None):
+        self.respond(
+            {"type": "error", "error": {"type": error_type, "message": "fake"}},
+            status,
+            headers,
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
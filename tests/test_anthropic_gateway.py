@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import pytest
+from anthropic import AsyncClient, InternalServerError
+
+import main
+from fake_anthropic import FakeAnthropic, message, stream_events
+
+
+def gateway(url: str, **overrides) -> main.AnthropicGateway:
+    options = {
+        "max_concurrency": 4,
+        "requests_per_minute": 1000,
+        "tokens_per_minute": 1_000_000,
+        "max_attempts": 3,
+        "breaker_threshold": 5,
+        "breaker_cooldown": 30,
+    }
+    options.update(overrides)
+    client = AsyncClient(
+        api_key="test", base_url=url, max_retries=0, http_client=httpx.AsyncClient()
+    )
+    return main.AnthropicGateway(client, **options)
+
+
+REQUEST = {
+    "model": "claude-fake",
+    "max_tokens": 1000,
+    "messages": [{"role": "user", "content": "Draw a circle"}],
+}
+
+
+def test_retries_rate_limits_and_honors_retry_after(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: 0.0)
+    with FakeAnthropic() as fake:
+        fake.error(429, "rate_limit_error", {"retry-after": "0"})
+        fake.respond(message("ok"))
+        api = gateway(fake.url)
+
+        reply = asyncio.run(api.create(**REQUEST))
+
+    assert reply.content[0].text == "ok"
+    assert len(fake.requests) == 2
+    assert api.stats()["retries"] == 1
+
+
+def test_each_retry_is_charged_to_the_rate_limiters(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: 0.0)
+    with FakeAnthropic() as fake:
+        fake.error(429, "rate_limit_error", {"retry-after": "0"})
+        fake.error(429, "rate_limit_error", {"retry-after": "0"})
+        fake.respond(message("ok"))
+        api = gateway(fake.url, requests_per_minute=60)
+
+        asyncio.run(api.create(**REQUEST))
+
+    assert len(fake.requests) == 3
+    assert api.request_bucket.available == pytest.approx(60 - 3, abs=0.5)
+
+
+def test_circuit_opens_and_fails_fast():
+    with FakeAnthropic() as fake:
+        for _ in range(2):
+            fake.error(500, "api_error")
+        api = gateway(fake.url, max_attempts=1, breaker_threshold=2)
+
+        async def run():
+            for _ in range(2):
+                with pytest.raises(InternalServerError):
+                    await api.create(**REQUEST)
+            with pytest.raises(main.CircuitOpenError):
+                await api.create(**REQUEST)
+
+        asyncio.run(run())
+
+    assert len(fake.requests) == 2
+    assert api.stats()["circuit_open"]
+
+
+def test_stream_closed_at_code_fence_is_charged_for_received_text():
+    chunks = ["```python\n", "from manim import *\n" * 40, "```", "\nmore"]
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events(chunks, finish=False))
+        api = gateway(fake.url)
+        refunds = []
+        api.token_bucket.refund = refunds.append
+
+        async def run():
+            async with api.stream(**REQUEST) as stream:
+                async for chunk in stream.text_stream:
+                    if chunk == "```":
+                        break
+
+        asyncio.run(run())
+
+    received_tokens = len("".join(chunks[:3])) // 4
+    assert refunds == [REQUEST["max_tokens"] - received_tokens]
@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import json
+import time
+
+import httpx
+from anthropic import AsyncClient
+from fastapi.testclient import TestClient
+
+import main
+from fake_anthropic import FakeAnthropic, stream_events
+
+gateway = getattr(main, "__anthropic")
+
+
+def test_chat_streams_reply_into_history(monkeypatch):
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events(["A circle is ", "round."]))
+        monkeypatch.setattr(
+            gateway,
+            "client",
+            AsyncClient(
+                api_key="test", base_url=fake.url, max_retries=0, http_client=httpx.AsyncClient()
+            ),
+        )
+        response = TestClient(main.app).post("/chat", json={"message": "What is a circle?"})
+
+    assert response.status_code == 200
+    assert response.text == "A circle is round."
+    history = main.chat_sessions[response.headers["x-session-id"]]
+    assert [entry["role"] for entry in history] == ["user", "assistant"]
+
+
+def test_chat_returns_503_while_circuit_is_open(monkeypatch):
+    monkeypatch.setattr(gateway, "opened_at", time.monotonic())
+
+    response = TestClient(main.app).post(
+        "/chat", json={"message": "What is a circle?", "session_id": "outage"}
+    )
+
+    assert response.status_code == 503
+    assert list(main.chat_sessions["outage"]) == []
+
+
+def test_chat_releases_its_slot_when_the_client_leaves_before_the_body(monkeypatch):
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client went away")
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat",
+        "raw_path": b"/chat",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    body = json.dumps({"message": "What is a circle?", "session_id": "gone"}).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive_body():
+        return messages.pop(0) if messages else await receive()
+
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events(["A circle is ", "round."]))
+        monkeypatch.setattr(
+            gateway,
+            "client",
+            AsyncClient(
+                api_key="test", base_url=fake.url, max_retries=0, http_client=httpx.AsyncClient()
+            ),
+        )
+
+        async def run():
+            with contextlib.suppress(Exception):
+                await main.app(scope, receive_body, send)
+            return gateway.in_flight, gateway.semaphore._value
+
+        in_flight, permits = asyncio.run(run())
+
+    assert in_flight == 0
+    assert permits == main.config.getint("ANTHROPIC", "MAX_CONCURRENT_REQUESTS", fallback=8)
+    assert list(main.chat_sessions["gone"]) == []
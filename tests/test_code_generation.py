@@ -0,0 +1,81 @@
+import asyncio
+
+import httpx
+from anthropic import AsyncClient
+
+import main
+from fake_anthropic import FakeAnthropic, stream_events
+
+gateway = getattr(main, "__anthropic")
+
+PREVIOUS_CODE = "from manim import *\n\nclass Demo(Scene):\n    def construct(self):\n        self.play(Create(Circle()))\n"
+FULL_CODE = "from manim import *\n\n\nclass Demo(Scene):\n    def construct(self):\n" + "".join(
+    f"        self.play(Create(Square(side_length={size})))\n" for size in range(1, 10)
+)
+
+
+def use_fake(monkeypatch, fake):
+    monkeypatch.setattr(
+        gateway,
+        "client",
+        AsyncClient(api_key="test", base_url=fake.url, max_retries=0, http_client=httpx.AsyncClient()),
+    )
+
+
+def test_unmatched_patch_asks_for_the_full_code(monkeypatch):
+    mismatch = "<<<<<<< SEARCH\n        self.play(Write(Circle()))\n=======\n        self.play(Create(Square()))\n>>>>>>> REPLACE\n"
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events([mismatch]))
+        fake.respond(stream_events([f"```python\n{FULL_CODE}```"]))
+        use_fake(monkeypatch, fake)
+
+        code = asyncio.run(
+            main.generate_manim_code(
+                "squares", error_message="NameError: name 'Write' is not defined",
+                previous_code=PREVIOUS_CODE,
+            )
+        )
+
+    assert code == FULL_CODE
+    assert "<<<<<<<" not in code
+    follow_up = fake.requests[1]["messages"]
+    assert follow_up[-2]["content"] == mismatch
+    assert "self.play(Write(Circle()))" in follow_up[-1]["content"]
+
+
+def test_stream_stops_at_the_closing_fence(monkeypatch):
+    monkeypatch.setattr(main, "PROGRESS_CHUNK_INTERVAL", 1)
+    monkeypatch.setitem(main.job_store, "job", {"status": "generating_code"})
+    progress = []
+    update_job = main.update_job
+    monkeypatch.setattr(
+        main,
+        "update_job",
+        lambda job_id, **fields: progress.append(fields.get("progress_details"))
+        or update_job(job_id, **fields),
+    )
+    lines = FULL_CODE.splitlines(keepends=True)
+    chunks = ["Here is the scene:\n```python\n", *lines, "```", "\nIt draws squares.", "\nMore prose."]
+
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events(chunks))
+        use_fake(monkeypatch, fake)
+        code = asyncio.run(
+            main.stream_code("job", model="claude-fake", max_tokens=1000, messages=[])
+        )
+
+    assert code == FULL_CODE
+    assert "It draws squares" not in code
+    read = chunks.index("```") + 1
+    assert progress == [f"Receiving code from Claude ({count} chunks)" for count in range(1, read + 1)]
+    assert main.job_store["job"]["progress_details"] == progress[-1]
+
+
+def test_generated_code_drops_prose_after_the_fence(monkeypatch):
+    with FakeAnthropic() as fake:
+        fake.respond(stream_events([f"```python\n{FULL_CODE}```", "\nThis scene draws squares."]))
+        use_fake(monkeypatch, fake)
+        code = asyncio.run(main.generate_manim_code("squares"))
+
+    assert code == FULL_CODE
+    assert fake.requests[0]["stream"] is True
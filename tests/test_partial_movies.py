@@ -0,0 +1,101 @@
+import errno
+import os
+
+import main
+
+
+def cross_device_link(source, target):
+    raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+
+def write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_partial_cache_follows_the_workspace_filesystem(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "SCRATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "SCRATCH_PARTIAL_CACHE_DIR", str(tmp_path / "partials"))
+
+    in_scratch = tmp_path / "manimation" / "job_1" / "scene.py"
+    assert main.partial_cache_dir(str(in_scratch)) == str(tmp_path / "partials")
+    assert main.partial_cache_dir("media/scratch/job_1/scene.py") == main.PARTIAL_CACHE_DIR
+
+
+def test_cross_device_seed_copies_into_the_run(monkeypatch, tmp_path):
+    cache_dir = tmp_path / "cache"
+    write(str(cache_dir / "abc.mp4"), b"movie")
+    monkeypatch.setattr(main.os, "link", cross_device_link)
+
+    partial_dir = tmp_path / "run" / "partial_movie_files"
+    main.seed_partial_movies(str(partial_dir), ["abc.mp4"], str(cache_dir))
+    os.remove(cache_dir / "abc.mp4")
+
+    seeded = partial_dir / "abc.mp4"
+    assert not seeded.is_symlink()
+    assert seeded.read_bytes() == b"movie"
+
+
+def write_file_list(partial_dir, names):
+    listing = "# This file is used internally by FFMPEG.\n" + "".join(
+        f"file 'file:{partial_dir / name}'\n" for name in names
+    )
+    write(str(partial_dir / "partial_movie_file_list.txt"), listing.encode())
+
+
+def test_cross_device_publish_leaves_only_complete_movies(monkeypatch, tmp_path):
+    partial_dir = tmp_path / "run"
+    write(str(partial_dir / "abc.mp4"), b"movie")
+    write_file_list(partial_dir, ["abc.mp4"])
+    monkeypatch.setattr(main.os, "link", cross_device_link)
+
+    cache_dir = tmp_path / "cache"
+    main.publish_partial_movies(str(partial_dir), str(cache_dir))
+
+    assert os.listdir(cache_dir) == ["abc.mp4"]
+    assert (cache_dir / "abc.mp4").read_bytes() == b"movie"
+
+
+def test_publish_only_refreshes_the_movies_the_run_used(tmp_path):
+    cache_dir = tmp_path / "cache"
+    for age, name in enumerate(["old1.mp4", "old2.mp4", "used.mp4"]):
+        write(str(cache_dir / name), b"movie")
+        os.utime(cache_dir / name, (1000 + age, 1000 + age))
+
+    partial_dir = tmp_path / "run"
+    main.seed_partial_movies(str(partial_dir), ["used.mp4", "gone.mp4"], str(cache_dir))
+    assert sorted(os.listdir(partial_dir)) == ["used.mp4"]
+
+    write(str(partial_dir / "new.mp4"), b"movie")
+    write_file_list(partial_dir, ["used.mp4", "new.mp4"])
+    assert main.publish_partial_movies(str(partial_dir), str(cache_dir)) == ["used.mp4", "new.mp4"]
+
+    assert os.stat(cache_dir / "old1.mp4").st_mtime == 1000
+    assert os.stat(cache_dir / "old2.mp4").st_mtime == 1001
+    assert os.stat(cache_dir / "used.mp4").st_mtime > 1002
+    assert (cache_dir / "new.mp4").exists()
+
+
+def test_scene_index_remembers_names_across_segments(monkeypatch):
+    monkeypatch.setattr(main, "partial_movie_index", main.OrderedDict())
+
+    main.remember_partial_movies("Intro", ["a.mp4", "b.mp4"])
+    main.remember_partial_movies("Intro", ["c.mp4"])
+
+    assert list(main.partial_movie_index["Intro"]) == ["a.mp4", "b.mp4", "c.mp4"]
+
+
+def test_scratch_cache_is_trimmed_to_its_own_quota(monkeypatch, tmp_path):
+    cache_dir = tmp_path / "partials"
+    monkeypatch.setattr(main, "SCRATCH_PARTIAL_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(main, "SCRATCH_PARTIAL_CACHE_MB", 1)
+    write(str(cache_dir / "old.mp4"), b"x" * 1024 * 1024)
+    os.utime(cache_dir / "old.mp4", (1000, 1000))
+
+    partial_dir = tmp_path / "run"
+    write(str(partial_dir / "new.mp4"), b"movie")
+    write_file_list(partial_dir, ["new.mp4"])
+    main.publish_partial_movies(str(partial_dir), str(cache_dir))
+
+    assert os.listdir(cache_dir) == ["new.mp4"]
@@ -0,0 +1,47 @@
+import main
+
+INHERITED_CONSTRUCT = """from manim import *
+
+class Base(Scene):
+    def construct(self):
+        self.play(Create(Circle(color=self.color())))
+
+    def color(self):
+        return BLUE
+
+class Red(Base):
+    def color(self):
+        return RED
+"""
+
+INHERITED_3D = """from manim import *
+
+class Base3D(ThreeDScene):
+    pass
+
+class Orbit(Base3D):
+    def construct(self):
+        self.set_camera_orientation(phi=75 * DEGREES)
+        self.play(Create(Sphere()))
+"""
+
+MISSING_CONSTRUCT = """from manim import *
+
+class Empty(Scene):
+    def helper(self):
+        pass
+"""
+
+
+def test_subclass_inheriting_construct_is_rendered():
+    assert main.scene_names(INHERITED_CONSTRUCT) == ["Base", "Red"]
+    assert "construct" not in (main.preflight_check(INHERITED_CONSTRUCT) or "")
+
+
+def test_subclass_of_three_d_scene_may_use_camera_methods():
+    assert "inherit from ThreeDScene" not in (main.preflight_check(INHERITED_3D) or "")
+    assert main.scene_names(INHERITED_3D) == ["Orbit"]
+
+
+def test_scene_without_construct_is_rejected():
+    assert "Empty has no construct() method" in main.preflight_check(MISSING_CONSTRUCT)
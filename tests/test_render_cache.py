@@ -0,0 +1,45 @@
+import os
+import threading
+
+import main
+
+
+def test_cache_entries_point_at_the_blob_not_the_job_link(monkeypatch, tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    os.makedirs(blob_dir)
+    with open(os.path.join(blob_dir, "abc.mp4"), "wb") as f:
+        f.write(b"preview")
+    monkeypatch.setattr(main, "BLOB_DIR", blob_dir)
+    monkeypatch.setattr(main, "code_cache", main.RenderCache(str(tmp_path / "code.json"), 8))
+    monkeypatch.setattr(main, "topic_cache", main.RenderCache(str(tmp_path / "topic.json"), 8))
+    monkeypatch.setitem(main.job_store, "job", {"video_sha": "abc"})
+
+    main.cache_render("job", "code-key", "topic-key", "videos/job.mp4", "preview")
+
+    for cache, key in ((main.code_cache, "code-key"), (main.topic_cache, "topic-key")):
+        entry = cache.get(key, is_valid=main.cached_video_valid)
+        assert entry["video_path"] == os.path.join(blob_dir, "abc.mp4")
+        assert entry["quality"] == "preview"
+
+
+def test_entries_naming_a_job_link_are_dropped(tmp_path):
+    video = tmp_path / "job.mp4"
+    video.write_bytes(b"final")
+
+    assert not main.cached_video_valid({"video_path": str(video), "video_sha": "abc"})
+
+
+def test_orphan_removal_waits_for_a_publish_in_progress(monkeypatch, tmp_path):
+    blob = tmp_path / "abc.mp4"
+    blob.write_bytes(b"video")
+    monkeypatch.setattr(main, "BLOB_DIR", str(tmp_path))
+
+    with main.blob_lock:
+        collector = threading.Thread(target=main.remove_orphan_blobs)
+        collector.start()
+        collector.join(timeout=0.2)
+        assert collector.is_alive()
+        os.link(blob, tmp_path / "job.mp4")
+    collector.join()
+
+    assert blob.exists()
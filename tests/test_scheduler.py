@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import main
+
+HIGH = main.PRIORITY_CLASSES["high"]
+NORMAL = main.PRIORITY_CLASSES["normal"]
+
+
+async def take(scheduler, job_id, priority, order, release):
+    async with scheduler.slot(job_id, priority):
+        order.append(job_id)
+        await release.wait()
+
+
+async def until(condition):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0)
+
+    await asyncio.wait_for(poll(), timeout=5)
+
+
+def test_waiters_run_by_priority_then_estimate_then_arrival(monkeypatch):
+    for job_id, cost in {"big": 100.0, "small": 1.0, "small_later": 1.0, "urgent": 500.0}.items():
+        monkeypatch.setitem(main.job_store, job_id, {"estimated_cost": cost})
+
+    async def run():
+        scheduler = main.StageScheduler("test", 1)
+        order, release = [], asyncio.Event()
+        holder = asyncio.create_task(take(scheduler, "holder", NORMAL, order, release))
+        await until(lambda: order)
+        waiters = []
+        for job_id, priority in [("big", NORMAL), ("small", NORMAL), ("small_later", NORMAL), ("urgent", HIGH)]:
+            waiters.append(asyncio.create_task(take(scheduler, job_id, priority, order, release)))
+            await until(lambda: len(scheduler.waiters) == len(waiters))
+
+        assert main.job_store["big"]["queue_position"] == 4
+        assert main.job_store["urgent"]["queue_position"] == 1
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+
+    assert order == ["holder", "urgent", "small", "small_later", "big"]
+    assert stats == {"active": 0, "limit": 1, "waiting": 0}
+
+
+def test_cancelling_a_waiter_leaves_the_queue():
+    async def run():
+        scheduler = main.StageScheduler("test", 1)
+        order, release = [], asyncio.Event()
+        holder = asyncio.create_task(take(scheduler, "holder", NORMAL, order, release))
+        await until(lambda: order)
+        waiter = asyncio.create_task(take(scheduler, "waiter", NORMAL, order, release))
+        await until(lambda: scheduler.waiters)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.stats()["waiting"] == 0
+
+        release.set()
+        await holder
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+
+    assert order == ["holder"]
+    assert stats["active"] == 0
+
+
+def test_cancelling_after_a_slot_was_granted_passes_it_on():
+    async def run():
+        scheduler = main.StageScheduler("test", 1)
+        order, release = [], asyncio.Event()
+        holder = scheduler.slot("holder")
+        await holder.__aenter__()
+        granted = asyncio.create_task(take(scheduler, "granted", NORMAL, order, release))
+        await until(lambda: len(scheduler.waiters) == 1)
+        next_in_line = asyncio.create_task(take(scheduler, "next", NORMAL, order, release))
+        await until(lambda: len(scheduler.waiters) == 2)
+
+        # Hand the slot to the first waiter, then cancel it before it gets to run
+        await holder.__aexit__(None, None, None)
+        assert len(scheduler.waiters) == 1
+        granted.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await granted
+
+        await until(lambda: order)
+        release.set()
+        await next_in_line
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+
+    assert order == ["next"]
+    assert stats == {"active": 0, "limit": 1, "waiting": 0}
@@ -0,0 +1,150 @@
+import asyncio
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import main
+from conftest import FIXTURES, ROOT
+
+SAMPLES = sorted(glob.glob(os.path.join(ROOT, "manim_code_*.py")))
+REAL_MANIM = shutil.which("ffmpeg") and importlib.util.find_spec("cairo") is not None
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_played_animations_reads_rich_log_layout():
+    output = read_fixture("manim_dry_run_output.txt")
+
+    assert main.played_animations(output) == {
+        "Intro": 4,
+        "DifferentiationVisualization": 12,
+        "AVeryLongSceneNameThatWillNotFitInTheColumn": 7,
+        "Outro": 1,
+    }
+
+
+def test_played_animations_ignores_colour_codes():
+    output = read_fixture("manim_dry_run_output.txt")
+    coloured = output.replace("INFO", "\x1b[32mINFO\x1b[0m").replace(
+        "Played", "\x1b[1mPlayed\x1b[0m"
+    )
+
+    assert main.played_animations(coloured)["Intro"] == 4
+
+
+def test_segment_ranges_cover_every_animation(monkeypatch):
+    monkeypatch.setattr(main, "PARALLEL_SEGMENTS", 3)
+    monkeypatch.setattr(main, "MIN_SEGMENT_ANIMATIONS", 4)
+
+    assert main.segment_ranges(13) == ["0,4", "5,8", "9"]
+    assert main.segment_ranges(7) == []
+
+
+def run_manim(cwd, *args) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-m", "manim", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        timeout=900,
+    )
+
+
+def frame_hashes(path: str) -> list:
+    output = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-i", path, "-map", "0:v", "-f", "framemd5", "-"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return [line.rsplit(",", 1)[1].strip() for line in output.splitlines() if not line.startswith("#")]
+
+
+@pytest.mark.skipif(not REAL_MANIM, reason="needs manim with cairo, and ffmpeg")
+@pytest.mark.parametrize("sample", SAMPLES, ids=os.path.basename)
+def test_segmented_render_matches_serial_render(sample, tmp_path, monkeypatch):
+    with open(sample, encoding="utf-8") as f:
+        code = f.read()
+    if main.split_hazard(code):
+        pytest.skip(f"rendered serially: {main.split_hazard(code)}")
+
+    script = tmp_path / "scene.py"
+    script.write_text(code, encoding="utf-8")
+    dry_run = run_manim(tmp_path, "--dry_run", "-a", "-ql", "scene.py")
+    if dry_run.returncode != 0:
+        pytest.skip("sample does not render")
+    counts = main.played_animations(dry_run.stdout + "\n" + dry_run.stderr)
+    assert counts
+
+    monkeypatch.setattr(main, "PARALLEL_SEGMENTS", 3)
+    monkeypatch.setattr(main, "MIN_SEGMENT_ANIMATIONS", 1)
+    for scene, count in counts.items():
+        ranges = main.segment_ranges(count)
+        if not ranges:
+            continue
+
+        serial = run_manim(tmp_path, "-ql", "-o", "serial", "scene.py", scene, "--media_dir", "serial")
+        assert serial.returncode == 0, serial.stderr
+
+        parts = []
+        for index, animations in enumerate(ranges):
+            media_id = f"{scene}_part{index}"
+            part = run_manim(
+                tmp_path, "-ql", "-n", animations, "-o", media_id, "scene.py", scene,
+                "--media_dir", media_id,
+            )
+            assert part.returncode == 0, part.stderr
+            parts.append(main.render_output_path(media_id, str(script)))
+
+        joined = str(tmp_path / f"{scene}_joined.mp4")
+        success, error_message = asyncio.run(main.concat_videos(parts, joined))
+        assert success, error_message
+        assert frame_hashes(joined) == frame_hashes(main.render_output_path("serial", str(script)))
+
+
+def test_output_path_follows_literal_config_in_the_script(tmp_path):
+    script = tmp_path / "scene.py"
+    script.write_text(
+        "from manim import *\n\nconfig.frame_rate = 30\n\n"
+        "class Intro(Scene):\n    def construct(self):\n        config.pixel_height = 720\n",
+        encoding="utf-8",
+    )
+
+    assert main.quality_dir(str(script)) == "480p30"
+    assert main.render_output_path("job", str(script)) == str(
+        tmp_path / "job" / "videos" / "scene" / "480p30" / "job.mp4"
+    )
+
+
+def test_output_path_finds_the_run_video_when_config_is_not_literal(tmp_path):
+    script = tmp_path / "scene.py"
+    script.write_text("from manim import *\n\nconfig.frame_rate = FPS\n", encoding="utf-8")
+    video = tmp_path / "job" / "videos" / "scene" / "480p24" / "job.mp4"
+    video.parent.mkdir(parents=True)
+    video.write_bytes(b"video")
+
+    assert main.render_output_path("job", str(script)) == str(video)
+
+
+def test_cost_log_sums_parallel_render_time(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "COST_LOG", str(tmp_path / "render_costs.jsonl"))
+    monkeypatch.setattr(main, "estimate_stats", {"samples": 0, "actual_to_predicted": 0.0})
+    monkeypatch.setitem(main.job_store, "job", {"timings": {"render": [10.0]}})
+
+    main.log_render_cost("job", {"cpu_seconds": 30.0}, "render", [10.0, 9.0, 11.0])
+
+    with open(main.COST_LOG, encoding="utf-8") as f:
+        record = json.loads(f.read())
+    assert record["actual_seconds"] == 30.0
+    assert record["parallel_runs"] == 3
+    assert record["wall_seconds"] == 10.0
+    assert main.estimate_stats["actual_to_predicted"] == 1.0